@@ -1,77 +1,253 @@
-
 import numpy as np
-import sys
 import os
-import faiss
-import json
 import time
-import torch
-import torchvision.transforms.v2 as tfms
-import open_clip
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
 from PIL import Image
 from imagehash import colorhash
-from vectorDB import VectorDB
+from vectorDB import VectorDB, top_k, color_dbs
+from faissDB import faiss_indexes, load_manifest, vectors_path, reconstruct, choose_index, train_size, build_index, undertrained, is_lossy, index_ids, all_vectors, remove_ids
 from hashDB import HashDB
 from colors import get_dominant_colors
+from featureStore import feature_store, text_embeddings
+from discovery import get_files, scan
+from models import embedding_tag, get_image_encoder, get_text_encoder, inference, model_tag, query_tag, use_int8
 
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE" # quick fix for a faiss bug
 
-if hasattr(sys, '_MEIPASS'):
-    torch.hub.set_dir(os.path.join(sys._MEIPASS, 'models', 'torch_hub'))
-    openclip_cache = os.path.join(sys._MEIPASS, 'models', 'openclip')
-else:
-    os.makedirs("./models", exist_ok=True)
-    torch.hub.set_dir('./models/torch_hub')
-    openclip_cache = './models/openclip'
+_update_locks = {} # (collection name, model) -> lock held while updating that index, see update_lock
+_update_locks_lock = threading.Lock()
+
+# torch, open_clip, onnxruntime and faiss are only imported by the functions that need them so color search stays fast to import
 
-dino = torch.hub.load('facebookresearch/dino:main', 'dino_vits16')
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-transform = tfms.Compose([
-    tfms.Resize(size= (224, 224), interpolation= 1),
-    tfms.ToImage(),
-    tfms.ToDtype(torch.float32, scale=True),
-    # tfms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-])
+def _load_image(path, preprocess):
+    """
+    Open an image and preprocess it for an embedding model (module level so process pools can pickle it)
 
-open_clip_model_name = "ViT-B-32"
-open_clip_pretrained_weights = "laion2b_s34b_b79k"
+    Args:
+        path (str): path of the image
+        preprocess (Callable): transform from PIL.Image to the model's input (torch.Tensor or numpy.ndarray)
 
-clip_model, clip_preprocess, clip_tokenizer = open_clip.create_model_and_transforms(
-    open_clip_model_name,
-    pretrained=open_clip_pretrained_weights,
-    device=device,
-    cache_dir=openclip_cache
-)
+    Returns:
+        torch.Tensor or numpy.ndarray
+    """
+    return preprocess(Image.open(path).convert("RGB"))
 
 
-def get_files(folder_path, explore = False):
+def load_batches(image_paths, preprocess, batch_size= 32, workers= None, prefetch= 4, processes= False):
     """
-    Get all the image file paths within a folder
+    Open and preprocess images in a pool of workers, a few batches ahead of whatever is using them\n
+    so the images are decoded while the model is running on the previous batch
 
     Args:
-        folder_path (str): folder of images
-        explore (bool, optional): True if including subfolders, default False
+        image_paths (list[str]): paths of the images
+        preprocess (Callable): transform from PIL.Image to the model's input (torch.Tensor or numpy.ndarray)
+        batch_size (int, optional): number of images in each batch. default 32
+        workers (int, optional): number of workers decoding images, None for the number of CPUs. default None
+        prefetch (int, optional): max number of batches being decoded or waiting to be used at once. default 4
+        processes (bool, optional): True to decode in processes instead of threads, which avoids the GIL but has to pickle every image. default False
+
+    Yields:
+        int: index in image_paths of the first image in the batch,
+        list[torch.Tensor or numpy.ndarray]: the preprocessed images of the batch, in order
+    """
+    workers = workers or os.cpu_count() or 1
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+    with Executor(max_workers= workers) as pool:
+        pending = deque() # (start, futures) of batches being decoded, oldest first
+        starts = iter(range(0, len(image_paths), batch_size))
+
+        def submit():
+            start = next(starts, None)
+            if start is not None:
+                pending.append((start, [pool.submit(_load_image, path, preprocess) for path in image_paths[start:start + batch_size]]))
+
+        for _ in range(max(prefetch, 1)):
+            submit()
+
+        while pending:
+            start, futures = pending.popleft()
+            # queue up the next batch before waiting so the workers never run out of images
+            submit()
+            yield start, [future.result() for future in futures]
+
+
+def file_hash(path):
+    """
+    Get a hash of a file's contents
+
+    Args:
+        path (str): path of the file
 
     Returns:
-        list[str]
+        str: hex digest
     """
-    image_paths = []
-    for file in tqdm(os.listdir(folder_path), desc= f"Exploring... ({folder_path})", disable= not explore):
-        # print(folder_path)
-        file_path = os.path.join(folder_path, file)
-        if explore and os.path.isdir(file_path):
-            image_paths += get_files(file_path, True)
-        elif os.path.isfile(file_path) and file.lower().endswith((".png", ".jpg", ".jpeg")):
-            image_paths.append(file_path)
+    h = hashlib.blake2b(digest_size= 16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def iter_embeddings(image_paths, model="dino", batch_size=32, progress=None, workers=None, prefetch=4, processes=False, int8=None):
+    """
+    Embed images with an image embedding model one batch at a time, so only the batches being decoded are in memory\n
+    images are decoded and preprocessed by a pool of workers while the model embeds the previous batches (see load_batches)
 
-    return image_paths
+    Args:
+        image_paths (list[str]): paths of the images
+        model (str, optional): embedding model to use (must be either "dino" or "clip"). default "dino"
+        batch_size (int, optional): batch size for embedding
+        progress (Callable, optional): called with the number of images embedded so far after each batch, default None
+        workers (int, optional): number of workers decoding images, None for the number of CPUs. default None
+        prefetch (int, optional): max number of batches decoded ahead of the model. default 4
+        processes (bool, optional): True to decode in processes instead of threads. default False
+        int8 (bool, optional): True to embed with the int8 quantized model (CPU only), None to use models.inference_settings. default None
+
+    Yields:
+        int: index in image_paths of the first image in the batch,
+        numpy.ndarray: float32 embeddings of the batch with shape (batch size, d). DINO embeddings are L2 normalized
+    """
+    import faiss
+
+    # set up with the inference settings (backend, threads, channels last, bf16, compile), see models.configure
+    encode, current_preprocess = get_image_encoder(model, int8)
+
+    bar = tqdm(total= len(image_paths), desc=f"Creating Embeddings with {model.upper()}...")
+    try:
+        for start, batch in load_batches(image_paths, current_preprocess, batch_size, workers, prefetch, processes):
+            with inference():
+                vectors = encode(batch)
+            done = start + len(batch)
+            if done == len(image_paths):
+                time.sleep(0.3)
+
+            if model == "dino":
+                faiss.normalize_L2(vectors)
+
+            bar.update(len(batch))
+            if progress:
+                progress(done)
+            yield start, vectors
+    finally:
+        bar.close()
+
+
+def embed_images(image_paths, model="dino", batch_size=32, progress=None, workers=None, prefetch=4, processes=False, int8=None):
+    """
+    Embed images with an image embedding model\n
+    images are decoded and preprocessed by a pool of workers while the model embeds the previous batches (see load_batches)
+
+    Args:
+        image_paths (list[str]): paths of the images
+        model (str, optional): embedding model to use (must be either "dino" or "clip"). default "dino"
+        batch_size, progress, workers, prefetch, processes, int8: see iter_embeddings
+
+    Returns:
+        numpy.ndarray: float32 embeddings with shape (len(image_paths), d). DINO embeddings are L2 normalized
+    """
+    all_embeddings = [vectors for _, vectors in iter_embeddings(image_paths, model, batch_size, progress, workers, prefetch, processes, int8)]
+
+    if not all_embeddings:
+        return np.zeros((0, 0), dtype= np.float32)
+    return np.concatenate(all_embeddings)
 
 
-def add_visual(name, folder_path, explore=False, batch_size=32, model="dino", progress=None):
+def iter_embeddings_stored(image_paths, model="dino", hashes=None, batch_size=32, progress=None, workers=None, prefetch=4, processes=False, int8=None):
     """
-    Add images from a folder to a FAISS index using an image embedding model
+    Embed images one batch at a time like iter_embeddings, reusing embeddings of identical images from the feature store
+    and adding the new ones to it (see featureStore)\n
+    stored embeddings come first, then the new ones in the order they're embedded
+
+    Args:
+        image_paths (list[str]): paths of the images
+        model (str, optional): embedding model to use (must be either "dino" or "clip"). default "dino"
+        hashes (list[str], optional): content hashes of the images (see file_hash) if they're already known. default None
+        batch_size, progress, workers, prefetch, processes, int8: see iter_embeddings
+
+    Yields:
+        list[int]: indexes in image_paths of the images in the batch,
+        numpy.ndarray: float32 embeddings of the batch with shape (batch size, d). DINO embeddings are L2 normalized
+    """
+    # int8 embeddings (and clip's from the onnx backend) are stored apart from float32 ones
+    tag = embedding_tag(model, int8)
+    if hashes is None:
+        hashes = [file_hash(path) for path in image_paths]
+
+    missing = []
+    # look up a chunk at a time so the stored embeddings aren't all loaded at once
+    for start in range(0, len(hashes), 500):
+        stored = feature_store.get_many(tag, hashes[start:start + 500])
+        found = [i for i in range(start, min(start + 500, len(hashes))) if hashes[i] in stored]
+        missing += [i for i in range(start, min(start + 500, len(hashes))) if hashes[i] not in stored]
+        if found:
+            yield found, np.stack([stored[hashes[i]] for i in found]).astype(np.float32)
+
+    # don't load the model if every image was stored
+    if not missing:
+        return
+    for start, vectors in iter_embeddings([image_paths[i] for i in missing], model, batch_size, progress, workers, prefetch, processes, int8):
+        batch = missing[start:start + len(vectors)]
+        feature_store.put_many(tag, {hashes[i] : vectors[j] for j, i in enumerate(batch)})
+        yield batch, vectors
+
+
+def embed_images_stored(image_paths, model="dino", hashes=None, batch_size=32, progress=None, workers=None, prefetch=4, processes=False, int8=None):
+    """
+    Embed images with an image embedding model, reusing embeddings of identical images from the feature store
+    and adding the new ones to it (see featureStore)
+
+    Args:
+        image_paths (list[str]): paths of the images
+        model (str, optional): embedding model to use (must be either "dino" or "clip"). default "dino"
+        hashes (list[str], optional): content hashes of the images (see file_hash) if they're already known. default None
+        batch_size, progress, workers, prefetch, processes, int8: see iter_embeddings
+
+    Returns:
+        numpy.ndarray: float32 embeddings with shape (len(image_paths), d). DINO embeddings are L2 normalized
+    """
+    vectors = [None] * len(image_paths)
+    for batch, batch_vectors in iter_embeddings_stored(image_paths, model, hashes, batch_size, progress, workers, prefetch, processes, int8):
+        for j, i in enumerate(batch):
+            vectors[i] = batch_vectors[j]
+
+    if not image_paths:
+        return np.zeros((0, 0), dtype= np.float32)
+    return np.stack(vectors).astype(np.float32)
+
+
+def update_lock(name, model):
+    """
+    Get the lock held while a collection's index is being updated (by add_visual or add_color),
+    so two updates of the same index never write its files at once
+
+    Args:
+        name (str): name of the collection
+        model (str): "dino", "clip" or "colors"
+
+    Returns:
+        threading.Lock
+    """
+    with _update_locks_lock:
+        return _update_locks.setdefault((name, model), threading.Lock())
+
+
+def add_visual(name, folder_path, explore=False, batch_size=32, model="dino", progress=None, workers=None, prefetch=4, processes=False, use_hash=False, use_store=True, target=None, codes=None, rerank=None, checkpoint_every=50, cancel=None):
+    """
+    Add images from a folder to a FAISS index using an image embedding model\n
+    if the index already exists, only new or changed images (by size and modified time) get embedded and removed images are dropped,
+    every other image keeps its id and embedding\n
+    the type of index (flat, IVF or HNSW) and how its vectors are compressed are picked from the size of the collection and target
+    (see faissDB.choose_index), and the index is remade when the collection outgrows it\n
+    embeddings go into the index as they're made, and every checkpoint_every batches the index is saved with the images done so far,
+    so a crashed or cancelled run continues where it stopped the next time it's called\n
+    the index is tagged with the model that made it (see models.embedding_tag), if the int8 setting or clip's backend changed since then
+    (see models.configure) the index is made again from scratch so embeddings made differently are never mixed
 
     Args:
         name (str): name for the index
@@ -80,88 +256,363 @@ def add_visual(name, folder_path, explore=False, batch_size=32, model="dino", pr
         batch_size (int, optional): batch size for embedding
         model (str, optional): embedding model to use (must be either "dino" or "clip"). default "dino"
         progress (QProgressDialog, optional): proress dialog to update while adding images, default None
+        workers (int, optional): number of workers decoding images, None for the number of CPUs. default None
+        prefetch (int, optional): max number of batches decoded ahead of the model. default 4
+        processes (bool, optional): True to decode in processes instead of threads. default False
+        use_hash (bool, optional): True to also compare file contents when the size or modified time changed,
+            so touched but unchanged files aren't embedded again. default False
+        use_store (bool, optional): True to reuse embeddings of identical images from other collections (see featureStore), default True
+        target (str, optional): "exact", "recall", "speed" or "balanced", see faissDB.choose_index. default None (the index's target or "balanced")
+        codes (str, optional): "float32", "fp16", "sq8" or "pq" to store the vectors compressed, see faissDB.choose_index.
+            default None (the index's choice or picked from the size)
+        rerank (bool, optional): True to keep the full precision vectors in a memory mapped file and re-rank results with them.
+            default None (the index's choice or False)
+        checkpoint_every (int, optional): number of batches between saves of the progress, 0 to only save at the end. default 50
+        cancel (Callable, optional): called after each batch, returns True to save the progress and stop (e.g. QThread.isInterruptionRequested). default None
+
+    Returns:
+        bool: True if every image was added, False if it was cancelled
     """
-    image_paths = get_files(folder_path, explore)
-    all_embeddings = []
-    current_batch_images = []
-
-    current_preprocess = None
-    if model == "dino":
-        current_preprocess = transform
-    elif model == "clip":
-        current_preprocess = clip_preprocess
-    else:
+    if model not in ("dino", "clip"):
         raise ValueError("Model must be 'dino' or 'clip'")
 
-    for i, path in enumerate(tqdm(image_paths, desc=f"Creating Embeddings with {model.upper()}...")):
-        image = Image.open(path).convert("RGB")
-        transformed_image = current_preprocess(image)
-        current_batch_images.append(transformed_image)
-        
-        # batching
-        if len(current_batch_images) == batch_size or i == len(image_paths) - 1:
-            batch_tensor = torch.stack(current_batch_images).to(device)
-            with torch.no_grad():
-                if model == "dino":
-                    embeddings_batch = dino(batch_tensor)
-                elif model == "clip":
-                    embeddings_batch = clip_model.encode_image(batch_tensor)
-            if i == len(image_paths) - 1:
-                time.sleep(0.3)
-            all_embeddings.append(embeddings_batch.cpu())
-            current_batch_images = []
-        if progress:
-            progress(i + 1)
+    # the app's index workers and the folder watchers can both update an index, one at a time
+    with update_lock(name, model):
+        return _add_visual(name, folder_path, explore, batch_size, model, progress, workers, prefetch, processes, use_hash, use_store, target, codes, rerank, checkpoint_every, cancel)
 
-    vectors = torch.cat(all_embeddings, dim=0).numpy().astype(np.float32)
 
-    if model == "dino":
-        faiss.normalize_L2(vectors)
+def _add_visual(name, folder_path, explore, batch_size, model, progress, workers, prefetch, processes, use_hash, use_store, target, codes, rerank, checkpoint_every, cancel):
+    """
+    Add images from a folder to a FAISS index, see add_visual (called with the index's update lock held)
+    """
+    import faiss
 
-    d = len(vectors[0])
-    index = None
+    # sizes and modified times come with the folder listing
+    entries = scan(folder_path, explore)
+    files = [entry.path for entry in entries]
 
-    # use inner product for dino and euclidean for clip
-    if model == "dino":
-        index = faiss.IndexFlatIP(d)
-    elif model == "clip":
-        index = faiss.IndexFlatL2(d)
+    index = None
+    image_paths = []
+    manifest = {}
+    params = None
+    side = None
+    if faiss_indexes.exists(name, model):
+        index, image_paths = faiss_indexes.get(name, model)
+        # searches keep using the loaded index, so make changes to a copy
+        index = faiss.clone_index(index)
+        image_paths = list(image_paths)
+        # ids at the end that aren't in the index (removed, or not embedded yet when a run was stopped) can be given out again
+        while image_paths and image_paths[-1] is None:
+            image_paths.pop()
+        manifest = load_manifest(name, model)
+        params = faiss_indexes.params(name, model) or {"type": "flat", "codes": "float32", "rerank": False, "trained_on": index.ntotal}
+        side = faiss_indexes.vectors(name, model)
+
+    # keep what the index was made with unless asked otherwise
+    if target is None:
+        target = params.get("target", "balanced") if params else "balanced"
+    if codes is None and params:
+        codes = params.get("compression")
+    if rerank is None:
+        rerank = params.get("rerank", False) if params else False
+
+    # indexes made before tags were stored are float32 from torch
+    tag = embedding_tag(model)
+    int8 = tag.endswith("_int8")
+    if params and params.get("tag", model_tag(model, int8= False)) != tag:
+        index = None
+        image_paths = []
+        manifest = {}
+        params = None
+        side = None
+
+    ids = {path : id for id, path in enumerate(image_paths) if path is not None}
+    new_manifest = {}
+    to_embed = [] # (path, id)
+
+    for path, size, mtime_ns in entries:
+        entry = [size, mtime_ns, None]
+        old = manifest.get(path)
+
+        if path not in ids:
+            ids[path] = len(image_paths)
+            image_paths.append(path)
+            to_embed.append((path, ids[path]))
+        # images indexed before the manifest existed are assumed to be up to date
+        elif old is not None and old[:2] != entry[:2]:
+            if use_hash:
+                entry[2] = file_hash(path)
+            if not use_hash or entry[2] != old[2]:
+                to_embed.append((path, ids[path]))
+        elif old is not None:
+            entry[2] = old[2]
+
+        if use_hash and entry[2] is None:
+            entry[2] = file_hash(path)
+        new_manifest[path] = entry
+
+    files = set(files)
+    removed = [id for path, id in ids.items() if path not in files]
+    for id in removed:
+        image_paths[id] = None
+
+    same = index is not None and rerank == params.get("rerank", False) and (side is not None or not rerank)
+    if same:
+        wanted = choose_index(len(files), index.d, target, codes, rerank)
+        same = wanted["type"] == params["type"] and wanted["codes"] == params.get("codes", "float32")
+
+    if not to_embed and not removed and same:
+        # only save if the manifest changed (e.g. touched files or an index made before manifests)
+        if new_manifest != manifest:
+            faiss_indexes.save(name, model, index, image_paths, new_manifest, params)
+        return True
+
+    embed_paths = [path for path, _ in to_embed]
+    embed_ids = np.array([id for _, id in to_embed], dtype= np.int64)
+
+    if index is None and not embed_paths:
+        raise ValueError(f"No images found in {folder_path}")
+
+    def embed(paths):
+        # yields (indexes in paths, embeddings) a batch at a time, always a generator so it can be closed
+        if not paths:
+            return
+        if use_store:
+            # use_hash already hashed them
+            hashes = [new_manifest[path][2] or file_hash(path) for path in paths]
+            yield from iter_embeddings_stored(paths, model, hashes, batch_size, progress, workers, prefetch, processes, int8)
+            return
+        for start, vectors in iter_embeddings(paths, model, batch_size, progress, workers, prefetch, processes, int8):
+            yield list(range(start, start + len(vectors))), vectors
+
+    def exact_vectors(index):
+        # compressed vectors are only close to the real embeddings, so get those from the full precision file or embed them again
+        ids = index_ids(index)
+        if side is not None:
+            return ids, np.asarray(side[ids], dtype= np.float32)
+        if is_lossy(params):
+            vectors = np.zeros((len(ids), index.d), dtype= np.float32)
+            for batch, batch_vectors in embed([image_paths[id] for id in ids]):
+                vectors[batch] = batch_vectors
+            return ids, vectors
+        return all_vectors(index)
+
+    # changed images keep their id, so drop their old embedding first
+    stale = np.concatenate([np.array(removed, dtype= np.int64), embed_ids])
+    if index is not None:
+        index = remove_ids(index, stale)
+
+    # remake the index when it's a different type than the collection needs now, or an IVF index was trained on far fewer images
+    # (unless that means embedding every image again), or its training was cut short
+    waiting_ids, waiting = [], [] # vectors waiting for the index to be made, it might have to train on them
+    if index is not None:
+        wanted = choose_index(len(files), index.d, target, codes, rerank)
+        exact = not is_lossy(params) or side is not None
+        if wanted["type"] != params["type"] or wanted["codes"] != params.get("codes", "float32") or \
+           (exact and wanted["type"] == "ivf" and len(files) > 4 * params["trained_on"]) or undertrained(params, len(files)):
+            old_ids, old_vectors = exact_vectors(index)
+            waiting_ids.append(old_ids)
+            waiting.append(old_vectors)
+            index = None
+    remade = index is None
+    total = len(embed_ids) + sum(len(ids) for ids in waiting_ids)
+
+    # full precision vectors are written to a memory mapped file as they come instead of being kept in memory
+    scratch = vectors_path(name, model) + ".building"
+    full = None
+
+    def add(ids, vectors):
+        nonlocal full
+        if rerank and full is None:
+            # row i is the vector of id i, rows of removed ids are never read
+            os.makedirs(os.path.dirname(scratch), exist_ok= True)
+            full = np.lib.format.open_memmap(scratch, mode= "w+", dtype= np.float32, shape= (len(image_paths), vectors.shape[1]))
+            if side is not None:
+                for start in range(0, min(len(side), len(full)), 65536):
+                    end = min(start + 65536, len(side), len(full))
+                    full[start:end] = side[start:end]
+            elif not remade:
+                # re-ranking was just turned on
+                old_ids, old_vectors = exact_vectors(index)
+                full[old_ids] = old_vectors
+        if len(ids):
+            index.add_with_ids(vectors, ids)
+            if full is not None:
+                full[ids] = vectors
+
+    def build():
+        nonlocal index, params
+        ids = np.concatenate(waiting_ids)
+        vectors = np.concatenate(waiting)
+        waiting_ids.clear()
+        waiting.clear()
+
+        # use inner product for dino and euclidean for clip
+        metric = faiss.METRIC_INNER_PRODUCT if model == "dino" else faiss.METRIC_L2
+        params = choose_index(len(files), vectors.shape[1], target, codes, rerank)
+        index = build_index(params, vectors.shape[1], metric, vectors)
+        add(ids, vectors)
+
+    # a checkpoint only has the images that are in the index, so the next run embeds the rest
+    pending = set(embed_ids.tolist())
+    done_manifest = {path : entry for path, entry in new_manifest.items() if ids[path] not in pending}
+
+    def checkpoint(cache):
+        params["rerank"] = rerank
+        params["tag"] = tag
+        paths = [None if id in pending else path for id, path in enumerate(image_paths)]
+        faiss_indexes.save(name, model, index, paths, done_manifest, params, full, cache)
+
+    cancelled = False
+    batches = 0
+    stream = embed(embed_paths)
+    try:
+        for batch, vectors in stream:
+            batch_ids = embed_ids[batch]
+            if index is None:
+                waiting_ids.append(batch_ids)
+                waiting.append(vectors)
+                needed = train_size(choose_index(len(files), vectors.shape[1], target, codes, rerank))
+                if sum(len(ids) for ids in waiting_ids) >= min(needed, total):
+                    build()
+            else:
+                add(batch_ids, vectors)
+
+            for id in batch_ids.tolist():
+                pending.discard(id)
+                done_manifest[image_paths[id]] = new_manifest[image_paths[id]]
+
+            batches += 1
+            if index is not None and checkpoint_every and batches % checkpoint_every == 0:
+                checkpoint(False)
+            if cancel is not None and cancel():
+                cancelled = True
+                break
+    finally:
+        stream.close()
+
+    if index is None and waiting:
+        if cancelled and use_store:
+            # stopped before the training sample was embedded, the feature store has every embedding made so far,
+            # so the next run gets them back without embedding again instead of keeping an index trained on a few of them
+            return False
+        # otherwise keep what was embedded, the index is trained again on a full sample next time (see faissDB.undertrained)
+        build()
+    if index is None:
+        # cancelled before anything was embedded
+        return False
+    if rerank and full is None:
+        add(np.zeros(0, dtype= np.int64), np.zeros((0, index.d), dtype= np.float32))
+    params["rerank"] = rerank
+    params["tag"] = tag
+    # unmap the old vectors file so the save can delete it (see faissDB.vectors_path)
+    side = None
+
+    if cancelled:
+        checkpoint(True)
+    else:
+        # save paths to a json file to map to embeddings with numeric ids
+        # searches already running keep the old index, new ones get this one
+        faiss_indexes.save(name, model, index, image_paths, new_manifest, params, full)
 
-    index = faiss.IndexIDMap(index)
+    if full is not None:
+        del full
+        os.remove(scratch)
+    return not cancelled
 
-    # numeric ids (maps to paths)
-    ids = np.array(range(len(image_paths)))
-    index.add_with_ids(vectors, ids)
 
-    # save paths to a json file to map to embeddings with numeric ids
-    faiss.write_index(index, os.path.join("collections", name, f"{name}_{model}.index"))
-    with open(os.path.join("collections", name, f"{name}_{model}_paths.json"), "w") as f:
-        json.dump(image_paths, f)
+def int8_recall(folder_path, model="dino", explore=False, sample=500, queries=50, k=10, batch_size=32):
+    """
+    Measure how close searches with the int8 quantized model are to searches with the float32 model on a sample of a collection,
+    to check it's accurate enough before turning it on (see models.configure)\n
+    each query image's k nearest neighbors among the sample (itself excluded) are found with both models' embeddings
 
+    Args:
+        folder_path (str): folder of images
+        model (str, optional): embedding model to check, "dino" or "clip". default "dino"
+        explore (bool, optional): True if including subfolders, default False
+        sample (int, optional): number of images embedded with both models, picked evenly from the folder. default 500
+        queries (int, optional): number of the sampled images used as queries. default 50
+        k (int, optional): number of nearest neighbors compared. default 10
+        batch_size (int, optional): batch size for embedding
 
-def add_color(name, folder_path, explore= False, progress=None):
+    Returns:
+        float: mean recall@k of the int8 results against the float32 results, 1.0 if they're the same
     """
-    Add images from a folder to a Vector_DB using a color index and save to JSON
+    if model not in ("dino", "clip"):
+        raise ValueError("Model must be 'dino' or 'clip'")
+    if not use_int8(True):
+        raise ValueError("int8 models only run with torch on CPU")
+
+    files = get_files(folder_path, explore)
+    if len(files) < 2:
+        raise ValueError(f"Not enough images in {folder_path}")
+    paths = [files[i] for i in np.linspace(0, len(files) - 1, min(sample, len(files))).astype(int)]
+    k = min(k, len(paths) - 1)
+
+    def neighbors(vectors):
+        # same metrics as the indexes: inner product for dino and euclidean for clip
+        query_ids = np.linspace(0, len(vectors) - 1, min(queries, len(vectors))).astype(int)
+        if model == "dino":
+            scores = vectors[query_ids] @ vectors.T
+        else:
+            scores = -((vectors[query_ids, None, :] - vectors[None, :, :]) ** 2).sum(-1)
+        scores[np.arange(len(query_ids)), query_ids] = -np.inf
+        return [set(top_k(row, k, largest= True).tolist()) for row in scores]
+
+    exact = neighbors(embed_images(paths, model, batch_size, int8= False))
+    quantized = neighbors(embed_images(paths, model, batch_size, int8= True))
+    return float(np.mean([len(a & b) / k for a, b in zip(exact, quantized)]))
+
+
+def add_color(name, folder_path, explore= False, progress=None, flush_every= 100, use_store= True, changed= None):
+    """
+    Add images from a folder to a Vector_DB using a color index and save it\n
+    each palette's LAB, HSV and normalized frequencies are stored with it so searching doesn't recompute them\n
+    new vectors are appended to the DB's log while indexing, so only images that aren't in the DB yet get written,
+    and images that are no longer in the folder are removed
 
     Args:
         name (str): name for the Vector_DB
         folder_path (str): folder of images
         explore (bool, optional): True if including subfolders, default False
         progress (QProgressDialog, optional): proress dialog to update while adding images, default None
+        flush_every (int, optional): number of images between appending new vectors to the log, default 100
+        use_store (bool, optional): True to reuse colors of identical images from other collections (see featureStore), default True
+        changed (list[str], optional): paths of images that were edited, their colors are computed again. default None
+    """
+    with update_lock(name, "colors"):
+        _add_color(name, folder_path, explore, progress, flush_every, use_store, changed)
+
+
+def _add_color(name, folder_path, explore, progress, flush_every, use_store, changed):
+    """
+    Add images from a folder to a Vector_DB, see add_color (called with the DB's update lock held)
     """
     image_paths = []
     image_paths = get_files(folder_path, explore)
+    changed = set(changed or ())
 
-    db = None
-    db = VectorDB.get_DB(name= name)
-    if not db:
-        db = VectorDB(name= name)
+    # shared with searches and open mosaic windows
+    db = color_dbs.get(name, create= True)
+    if type(db) == VectorDB:
+        files = set(image_paths)
+        db.remove_vectors([path for path in db.paths if path not in files])
+    tag = model_tag("colors")
+    new_features = {} # hash -> colors to add to the feature store
 
     for i, path in enumerate(tqdm(image_paths, desc= f"Creating Embeddings and Adding to DB...")):
         try:
             if type(db) == VectorDB:
-                if db.get_vector(path) == None:
-                    cols = get_dominant_colors(Image.open(path, mode= "r"), num_colors= 5)
+                if db.get_vector(path) is None or path in changed:
+                    cols = None
+                    if use_store:
+                        key = file_hash(path)
+                        cols = feature_store.get(tag, key)
+                    if cols is None:
+                        cols = get_dominant_colors(Image.open(path, mode= "r"), num_colors= 5)
+                        if use_store:
+                            new_features[key] = cols
                     db.add_vector(id= path,vec= cols)
             elif type(db) == HashDB:
                 hash = colorhash(Image.open(path), binbits = 7)
@@ -170,8 +621,113 @@ def add_color(name, folder_path, explore= False, progress=None):
             print(f"Error processing {path} : {e}")
         if progress:
             progress(i + 1)
-            
-    db.save_DB()
+        # a crash only loses the images since the last flush
+        if (i + 1) % flush_every == 0:
+            db.flush()
+            feature_store.put_many(tag, new_features)
+            new_features = {}
+
+    db.flush()
+    feature_store.put_many(tag, new_features)
+    # rewriting the main files is only worth it once the log gets big
+    if db.needs_compaction():
+        db.compact(background= True)
+
+
+def _to_results(distances, indices, image_paths, k, largest= False):
+    """
+    Turn the output of a faiss search into result dicts, only making dicts for the k best
+
+    Args:
+        distances (numpy.ndarray): distances of one query returned by index.search
+        indices (numpy.ndarray): ids of one query returned by index.search
+        image_paths (list[str]): paths that the ids map to
+        k (int): number of results to return, -1 for all
+        largest (bool, optional): True if the distances are similarities (bigger is better). default False
+
+    Returns:
+        list[dict]: sorted by distance list of results with keys "path" and "distance"
+    """
+    # faiss pads with -1 if there are less than k results
+    valid = (indices >= 0) & (indices < len(image_paths))
+    distances = distances[valid]
+    indices = indices[valid]
+
+    return [{"path": image_paths[indices[i]], "distance": distances[i]} for i in top_k(distances, k, largest= largest)]
+
+
+def _index_int8(name, model):
+    """
+    Check if an index was made with the int8 quantized model, from the tag saved with it (see add_visual)
+
+    Args:
+        name (str): name of the index
+        model (str): embedding model of the index, "dino" or "clip"
+
+    Returns:
+        bool
+    """
+    params = faiss_indexes.params(name, model) or {}
+    return params.get("tag", "").endswith("_int8")
+
+
+def _query_embeddings(name, model, index, file_paths, batch_size = 32):
+    """
+    Get the embeddings of query images, reusing the ones in the index if the images are in the collection
+    or the ones in the feature store if identical images were embedded before, so the model only runs for new images
+
+    Args:
+        name (str): name of the index being searched
+        model (str): embedding model of the index, "dino" or "clip"
+        index (faiss.Index): the index being searched
+        file_paths (list[str]): paths of the query images
+        batch_size (int, optional): number of new images embedded in each forward pass. default 32
+
+    Returns:
+        numpy.ndarray: float32 embeddings with shape (len(file_paths), d), L2 normalized for DINO
+    """
+    vectors = [None] * len(file_paths)
+    side = faiss_indexes.vectors(name, model)
+    # compressed vectors are only close to the real embedding, the feature store has the real one
+    lossy = is_lossy(faiss_indexes.params(name, model))
+    int8 = _index_int8(name, model)
+    for i, id in enumerate(faiss_indexes.find_many(name, model, file_paths)):
+        if id is not None and side is not None and id < len(side):
+            vectors[i] = np.asarray(side[id], dtype= np.float32)
+        elif id is not None and not lossy:
+            vector = reconstruct(index, id)
+            vectors[i] = vector[0] if vector is not None else None
+
+    # clip's index images are cropped at random (see models.get_clip), so its queries are embedded and stored apart
+    tag, query = embedding_tag(model, int8), query_tag(model, int8)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    hashes = {i : file_hash(file_paths[i]) for i in missing}
+    for stored_tag in dict.fromkeys((query, tag)):
+        stored = feature_store.get_many(stored_tag, [hashes[i] for i in missing if vectors[i] is None])
+        for i in missing:
+            if vectors[i] is None and hashes[i] in stored and len(stored[hashes[i]]) == index.d:
+                vectors[i] = stored[hashes[i]]
+
+    missing = [i for i in missing if vectors[i] is None]
+    if missing:
+        import faiss
+
+        # same model as embed_images, with a transform that doesn't crop at random so a query always gets the same embedding
+        encode, transform = get_image_encoder(model, int8, query= True)
+
+        computed = []
+        for _, batch in load_batches([file_paths[i] for i in missing], transform, batch_size):
+            with inference():
+                computed.append(encode(batch).astype(np.float32))
+        computed = np.concatenate(computed)
+        if model == "dino":
+            faiss.normalize_L2(computed)
+
+        feature_store.put_many(query, {hashes[i] : computed[j] for j, i in enumerate(missing)})
+        for j, i in enumerate(missing):
+            vectors[i] = computed[j]
+
+    return np.stack(vectors).astype(np.float32)
 
 
 def search_visual(name, file_path, k = 5):
@@ -189,35 +745,78 @@ def search_visual(name, file_path, k = 5):
                 "path" (Any): the respective image path to the image embedding
                 "distance" (float): distance to the query
     """
-    index = faiss.read_index(os.path.join("collections", name, f"{name}_dino.index"))
+    return search_visual_many(name, [file_path], k)[0]
+
+
+def search_visual_many(name, file_paths, k = 5):
+    """
+    Get the k nearest neighbors of a dino index for many query images, embedding the new ones together and searching them in one batch
+
+    Args:
+        name (str): name of index to search
+        file_paths (list[str]): paths of images to embed into DINO and query
+        k (int, optional): number of nearest neighbors to return for each query, default 5
+
+    Returns:
+            list[list[dict]]: the results of each query, see search_visual
+    """
+    # stays loaded between searches
+    index, image_paths = faiss_indexes.get(name, "dino")
 
     if k == -1:
         k = index.ntotal
+    if not file_paths:
+        return []
 
-    query_image = Image.open(file_path).convert("RGB").resize((224, 224))
-    query_tensor = transform(query_image).unsqueeze(0).to(device)
-    
-    with torch.no_grad():
-        query_embedding = dino(query_tensor).cpu().numpy()
-        faiss.normalize_L2(query_embedding)
-    
-    distances, indices = index.search(query_embedding, k)
-    indices = indices[0]
-    distances = distances[0]
-
-    # load the original image paths to map back to embeddings
-    with open(os.path.join("collections", name, f"{name}_dino_paths.json"), "r") as f:
-        image_paths = json.load(f)
-        
-    results = []
-    for i in range(len(indices)):
-        if indices[i] < len(image_paths):
-            results.append({"path": image_paths[indices[i]], "distance": distances[i]})
+    query_embeddings = _query_embeddings(name, "dino", index, file_paths)
+    distances, indices = faiss_indexes.search(name, "dino", query_embeddings, k)
 
     # not actually distance its similarity so reverse
-    results.sort(key= lambda x: x["distance"], reverse= True)
+    return [[{"path": file_path, "distance": 0}] + _to_results(distances[i], indices[i], image_paths, k, largest= True)
+            for i, file_path in enumerate(file_paths)]
+
+
+def search_clip_image(name, file_path, k = 5):
+    """
+    Get the k nearest neighbors of a clip index using a query image
+
+    Args:
+        name (str): name of index to search
+        file_path (str): path of image to embed into CLIP and query
+        k (int, optional): number of nearest neighbors to return, default 5
+
+    Returns:
+            list[dict]: sorted by distance list of k nearest neighbors represented by a dictionary with keys:
+                "path" (Any): the respective image path to the image embedding
+                "distance" (float): distance to the query
+    """
+    return search_clip_image_many(name, [file_path], k)[0]
+
+
+def search_clip_image_many(name, file_paths, k = 5):
+    """
+    Get the k nearest neighbors of a clip index for many query images, embedding the new ones together and searching them in one batch
+
+    Args:
+        name (str): name of index to search
+        file_paths (list[str]): paths of images to embed into CLIP and query
+        k (int, optional): number of nearest neighbors to return for each query, default 5
 
-    return [{"path": file_path, "distance": 0}] + results
+    Returns:
+            list[list[dict]]: the results of each query, see search_clip_image
+    """
+    index, image_paths = faiss_indexes.get(name, "clip")
+
+    if k == -1:
+        k = index.ntotal
+    if not file_paths:
+        return []
+
+    query_embeddings = _query_embeddings(name, "clip", index, file_paths)
+    distances, indices = faiss_indexes.search(name, "clip", query_embeddings, k)
+
+    return [[{"path": file_path, "distance": 0}] + _to_results(distances[i], indices[i], image_paths, k)
+            for i, file_path in enumerate(file_paths)]
 
 
 def search_clip(name, query : str, k = 5):
@@ -234,34 +833,42 @@ def search_clip(name, query : str, k = 5):
                 "path" (Any): the respective image path to the image embedding
                 "distance" (float): distance to the query
     """
+    return search_clip_many(name, [query], k)[0]
 
-    index = faiss.read_index(os.path.join("collections", name, f"{name}_clip.index"))
 
-    if k == -1:
-        k = index.ntotal
+def search_clip_many(name, queries, k = 5):
+    """
+    Get the k nearest neighbors of a clip index for many query texts, encoding the uncached ones together and searching them in one batch
 
-    text_tokens = open_clip.tokenize(query).to(device)
+    Args:
+        name (str): name of index to search
+        queries (list[str]): texts to embed into CLIP and query
+        k (int, optional): number of nearest neighbors to return for each query, default 5
 
-    with torch.no_grad():
-        query_embedding = clip_model.encode_text(text_tokens)
-        query_embedding = query_embedding.cpu().numpy()
+    Returns:
+            list[list[dict]]: the results of each query, see search_clip
+    """
+    index, image_paths = faiss_indexes.get(name, "clip")
 
-    distances, indices = index.search(query_embedding, k)
+    if k == -1:
+        k = index.ntotal
+    if not queries:
+        return []
 
-    indices = indices[0]
-    distances = distances[0]
+    # queries are embedded by the same model as the images (float32 or int8)
+    int8 = _index_int8(name, "clip")
 
-    with open(os.path.join("collections", name, f"{name}_clip_paths.json"), "r") as f:
-        image_paths = json.load(f)
+    def embed(queries):
+        encode = get_text_encoder(int8)
+        with inference():
+            return encode(queries)
 
-    results = []
-    for i in range(len(indices)):
-        if indices[i] < len(image_paths):
-            results.append({"path": image_paths[indices[i]], "distance": distances[i]})
+    # repeated queries skip the text encoder
+    query_embeddings = text_embeddings.get_many(model_tag("clip", int8), queries, embed)
 
-    results.sort(key=lambda x: x["distance"])
+    distances, indices = faiss_indexes.search(name, "clip", query_embeddings, k)
 
-    return results
+    return [_to_results(distances[i], indices[i], image_paths, k) for i in range(len(queries))]
 
 
 def search_color(name, rgb= None, path= None, k = 5):
@@ -282,34 +889,57 @@ def search_color(name, rgb= None, path= None, k = 5):
                 "colors" (numpy.ndarray): the color vector of an image which has the following structure:\n
                 [red (of most dominant color), blue, green, frequency, red (of 2nd most dominant color), blue, green, frequency, ...]
     """
-    query_image = None
-
+    # the same search as a batch of one, so both use the stored colors of known images
     if rgb and len(rgb) == 3:
-        query_image = Image.new('RGB', (10, 10), rgb)
+        return search_color_many(name, rgbs= [rgb], k= k)[0]
     elif path:
-        query_image = Image.open(path, mode= "r")
-    else:
-        raise Exception("Enter RGB values ((R, G, B)), PIL Image, or image path (str)")
+        return search_color_many(name, paths= [path], k= k)[0]
+    raise Exception("Enter RGB values ((R, G, B)), PIL Image, or image path (str)")
 
-    # you can create a Hash_DB but im just using Vector_DB
-    db = VectorDB.get_DB(name= name)
 
-    images = []
+def search_color_many(name, rgbs= None, paths= None, k = 5):
+    """
+    Get the k nearest neighbors of a color index for many queries, scoring every query in one pass
 
-    vec = []
-    if type(db) == VectorDB:
-        vec = get_dominant_colors(query_image, num_colors= 5)
-        images = db.knn(vec, k= k)
-    elif type(db) == HashDB:
-        images = db.knn(colorhash(query_image, binbits = 7), k= k)
+    Args:
+        name (str): name of index to search
+        rgbs (list[tuple], optional): if querying by color, RGB values in the form (R, G, B). default None (then must input paths)
+        paths (list[str], optional): if querying by image, paths of images to query. default None (then must input rgbs)
+        k (int, optional): number of nearest neighbors to return for each query, default 5
+
+    Returns:
+            list[list[dict]]: the results of each query, see search_color
+    """
+    if rgbs is not None:
+        query_images = [Image.new('RGB', (10, 10), rgb) for rgb in rgbs]
+        vecs = [get_dominant_colors(query_image, num_colors= 5) for query_image in query_images]
+    elif paths is not None:
+        query_images = [None] * len(paths)
+        # images from this or other collections already have their colors stored
+        hashes = [file_hash(path) for path in paths]
+        stored = feature_store.get_many(model_tag("colors"), hashes)
+        vecs = [stored.get(hash) for hash in hashes]
+        for i, path in enumerate(paths):
+            if vecs[i] is None:
+                query_images[i] = Image.open(path, mode= "r")
+                vecs[i] = get_dominant_colors(query_images[i], num_colors= 5)
+        feature_store.put_many(model_tag("colors"), {hashes[i] : vecs[i] for i in range(len(paths)) if query_images[i] is not None})
+    else:
+        raise Exception("Enter RGB values ([(R, G, B), ...]) or image paths ([str, ...])")
 
-    for i, image in enumerate(images):
-        images[i]["path"] = image["path"]
+    db = color_dbs.get(name)
 
-    if path:
-        return [{"path": path, "distance": 0, "colors": vec}] + images
+    if type(db) == VectorDB:
+        results = db.knn_many(vecs, k= k)
+    elif type(db) == HashDB:
+        results = [db.knn(colorhash(query_image or Image.open(path, mode= "r"), binbits = 7), k= k)
+                   for query_image, path in zip(query_images, paths or [None] * len(vecs))]
     else:
-        return [{"image": query_image, "distance": 0, "colors": vec}] + images
+        results = [[] for _ in vecs]
+
+    if paths is not None:
+        return [[{"path": path, "distance": 0, "colors": vec}] + images for path, vec, images in zip(paths, vecs, results)]
+    return [[{"image": query_image, "distance": 0, "colors": vec}] + images for query_image, vec, images in zip(query_images, vecs, results)]
 
 if __name__ == "__main__":
     pass
@@ -170,6 +170,184 @@ def multidist(i1, i2, k = 4):
     distance = (distance / tf) if tf != 0 else 0 # normalize by earlier weights
     return distance
 
+
+def rgb_to_hsv(rgb):
+    """
+    Vectorized version of colorsys.rgb_to_hsv
+
+    Args:
+        rgb (numpy.ndarray): array of RGB values between 0 and 1 with shape (..., 3)
+
+    Returns:
+        numpy.ndarray of HSV values between 0 and 1 with shape (..., 3)
+    """
+    rgb = np.asarray(rgb, dtype= np.float64)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+
+    maxc = rgb.max(axis= -1)
+    minc = rgb.min(axis= -1)
+    rangec = maxc - minc
+    grey = rangec == 0
+
+    # avoid dividing by zero for greys, their hue and saturation are 0 anyways
+    safe_range = np.where(grey, 1, rangec)
+    safe_max = np.where(maxc == 0, 1, maxc)
+    s = np.where(grey, 0, rangec / safe_max)
+    rc = (maxc - r) / safe_range
+    gc = (maxc - g) / safe_range
+    bc = (maxc - b) / safe_range
+
+    # same order of checks as colorsys so ties pick the same hue
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(grey, 0, (h / 6.0) % 1.0)
+
+    return np.stack([h, s, maxc], axis= -1)
+
+
+def rgb_to_lab(rgb):
+    """
+    Convert RGB values to LAB color space in one pass
+
+    Args:
+        rgb (numpy.ndarray): array of RGB values between 0 and 255 with shape (..., 3)
+
+    Returns:
+        numpy.ndarray of LAB values with shape (..., 3)
+    """
+    rgb = np.asarray(rgb, dtype= np.float64) / 255.0
+    return rgb2lab(rgb.reshape(-1, 1, 3)).reshape(rgb.shape)
+
+
+def stack_palettes(vecs, num_colors= 5, width= 4):
+    """
+    Stack RGBF vectors of different lengths into one zero padded palette array
+
+    Args:
+        vecs (list[numpy.ndarray]): RGBF vectors with the structure returned by get_dominant_colors
+        num_colors (int, optional): number of colors to pad each palette to. default 5
+        width (int, optional): number of values per color, 4 for RGBF vectors or 7 for palette_features. default 4
+
+    Returns:
+        numpy.ndarray with shape (len(vecs), num_colors, width). padded colors are all 0 (so frequency of 0)
+    """
+    palettes = np.zeros((len(vecs), num_colors, width), dtype= np.float64)
+    for i, vec in enumerate(vecs):
+        vec = np.asarray(vec).reshape(-1, width)[:num_colors]
+        palettes[i, :len(vec)] = vec
+    return palettes
+
+
+def palette_features(palettes):
+    """
+    Precompute everything multidist_many needs from a palette so it only has to be done once per image
+
+    Args:
+        palettes (numpy.ndarray): RGBF palettes with shape (..., num colors, 4), see stack_palettes
+
+    Returns:
+        numpy.ndarray with shape (..., num colors, 7) with the following structure for each color:
+            [L, A, B, hue, saturation, value, frequency normalized by the most dominant color's frequency]
+    """
+    p = np.asarray(palettes, dtype= np.float64)
+    maxf = p[..., :1, 3]
+    nf = p[..., 3] / np.where(maxf == 0, 1, maxf)
+    return np.concatenate([rgb_to_lab(p[..., :3]), rgb_to_hsv(p[..., :3] / 255), nf[..., None]], axis= -1)
+
+
+def _multidist_features(q, p, n1):
+    """
+    multidist between every pair of query and palette features, see multidist_many
+
+    Args:
+        q (numpy.ndarray): palette_features of the queries with shape (Q, k, 7)
+        p (numpy.ndarray): palette_features of the palettes with shape (N, k, 7), colors with frequency 0 are padding
+        n1 (numpy.ndarray): number of colors in each query
+
+    Returns:
+        numpy.ndarray of distances with shape (Q, N)
+    """
+    n2 = np.count_nonzero(p[..., 6] > 0, axis= 1)
+
+    hsv1 = q[:, None, :, None, 3:6] # (Q, 1, k, 1, 3)
+    hsv2 = p[None, :, None, :, 3:6] # (1, N, 1, k, 3)
+
+    # same penalty as multidist, see comments there
+    hd = np.abs(hsv1[..., 0] - hsv2[..., 0])
+    hd = np.minimum(hd, 1 - hd) * 2
+    hw = 300
+    sw = (hsv1[..., 1] + hsv2[..., 1]) / 2
+    v = (1 - np.abs((hsv1[..., 2] + hsv2[..., 2]) / 2 - 0.2) / 0.8)
+    pen = hw * hd * sw * v
+
+    # frequencies are already normalized by the frequency of the most dominant color
+    gmf = np.sqrt(q[:, None, :, None, 6] * p[None, :, None, :, 6]) # (Q, N, k, k)
+
+    labd = np.linalg.norm(q[:, None, :, None, :3] - p[None, :, None, :, :3], axis= -1)
+
+    distance = ((labd + pen) * gmf).sum(axis= (2, 3))
+    tf = gmf.sum(axis= (2, 3))
+
+    distance /= np.asarray(n1)[:, None] * np.maximum(n2, 1)[None, :]
+    distance = np.divide(distance, tf, out= np.zeros_like(distance), where= tf != 0)
+    return distance
+
+
+def multidist_many(query, palettes= None, k = 4, features= None):
+    """
+    Get the multidist color distance between one query and many color vectors at once\n
+    gives the same distances as calling multidist(query, palette) for every palette
+
+    Args:
+        query (list or numpy.ndarray): RGBF vector with the following structure:
+            [red (of most dominant color), blue, green, frequency, red (of 2nd most dominant color), blue, green, frequency, ...]
+        palettes (numpy.ndarray, optional): palettes to compare with shape (N, num colors, 4). colors with frequency 0 are treated as padding
+            (see stack_palettes). not needed if features is given
+        k (int): max number of colors to compare in each set
+        features (numpy.ndarray, optional): palette_features of the palettes with shape (N, num colors, 7). if given, only the
+            query's colors get converted
+
+    Returns:
+        numpy.ndarray of N distances
+    """
+    if features is None:
+        features = palette_features(palettes)
+
+    q = palette_features(np.asarray(query, dtype= np.float64).reshape(-1, 4))[:k]
+    p = np.asarray(features)[:, :k].astype(np.float64)
+
+    return _multidist_features(q[None], p, [len(q)])[0]
+
+
+def multidist_matrix(queries, palettes= None, k = 4, features= None, chunk_bytes= 2**26):
+    """
+    Get the multidist color distance between many queries and many color vectors at once\n
+    gives the same distances as calling multidist_many for every query
+
+    Args:
+        queries (list[numpy.ndarray]): RGBF vectors with the structure returned by get_dominant_colors
+        palettes (numpy.ndarray, optional): palettes to compare with shape (N, num colors, 4), see multidist_many
+        k (int): max number of colors to compare in each set
+        features (numpy.ndarray, optional): palette_features of the palettes with shape (N, num colors, 7), see multidist_many
+        chunk_bytes (int, optional): roughly the most memory used by one chunk of queries. default 64 MiB
+
+    Returns:
+        numpy.ndarray of distances with shape (len(queries), N)
+    """
+    if features is None:
+        features = palette_features(palettes)
+
+    q = palette_features(stack_palettes(queries, num_colors= max([len(np.ravel(query)) // 4 for query in queries] + [k])))[:, :k]
+    p = np.asarray(features)[:, :k].astype(np.float64)
+    n1 = np.array([min(len(np.ravel(query)) // 4, k) for query in queries])
+
+    distances = np.empty((len(q), len(p)), dtype= np.float64)
+    # every (query, palette) pair needs k * k colors compared, so do a few queries at a time
+    step = max(1, chunk_bytes // max(1, len(p) * k * k * 8 * 4))
+    for start in range(0, len(q), step):
+        distances[start:start + step] = _multidist_features(q[start:start + step], p, n1[start:start + step])
+    return distances
+
+
 def create_bar(height, width, color):
     """
     Create solid bar of input color
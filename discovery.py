@@ -0,0 +1,162 @@
+"""finds the images in a collection's folder, shared by the image counts shown in the app and the indexing so they always agree\n
+folders are listed with os.scandir (type, size and modified time come with the listing instead of a stat call per file on most systems),
+subfolders are listed in parallel, and results are cached until a folder changes"""
+
+import os
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# every extension the app counts, indexes and lets you pick
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tiff")
+# for QFileDialog
+IMAGE_FILTER = f"Image Files ({' '.join('*' + ext for ext in IMAGE_EXTENSIONS)})"
+
+FileEntry = namedtuple("FileEntry", ["path", "size", "mtime_ns"])
+
+_cache = {} # (normalized folder, explore, folder as given) -> (time scanned, {folder : modified time}, list[FileEntry])
+_lock = threading.Lock()
+
+
+def _list_folder(folder):
+    """
+    List the images and subfolders directly in a folder
+
+    Args:
+        folder (str): path of the folder
+
+    Returns:
+        list: in listing order, FileEntry for images and str (the path) for subfolders
+    """
+    items = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    items.append(entry.path)
+                elif entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    st = entry.stat()
+                    items.append(FileEntry(entry.path, st.st_size, st.st_mtime_ns))
+            except OSError:
+                # removed while listing
+                continue
+    return items
+
+
+def _folder_mtimes(folders):
+    mtimes = {}
+    for folder in folders:
+        try:
+            mtimes[folder] = os.stat(folder).st_mtime_ns
+        except OSError:
+            mtimes[folder] = None
+    return mtimes
+
+
+def scan(folder_path, explore= False, workers= None, max_age= 30, refresh= False):
+    """
+    Get the images in a folder with their size and modified time\n
+    a cached result is reused if it's younger than max_age and no folder in it was changed (a file added, removed or renamed)
+
+    Args:
+        folder_path (str): folder of images
+        explore (bool, optional): True if including subfolders, default False
+        workers (int, optional): number of threads listing subfolders at once, None for 4 per CPU. default None
+        max_age (float, optional): max seconds a cached result is reused, edited files don't change their folder. default 30
+        refresh (bool, optional): True to always list the folders again. default False
+
+    Returns:
+        list[FileEntry]: (path, size, mtime_ns) of each image, in listing order with each subfolder's images where the subfolder is
+    """
+    # the paths start with the folder as it's given, and they're the ids in the indexes, so other spellings get their own scan
+    key = (os.path.normpath(os.path.abspath(folder_path)), explore, folder_path)
+    with _lock:
+        cached = _cache.get(key)
+    if cached is not None and not refresh and time.time() - cached[0] < max_age and _folder_mtimes(cached[1]) == cached[1]:
+        return list(cached[2])
+
+    scanned = time.time()
+    listings = {folder_path : _list_folder(folder_path)}
+    seen = {os.path.realpath(folder_path)}
+    level = [item for item in listings[folder_path] if isinstance(item, str)] if explore else []
+
+    with ThreadPoolExecutor(max_workers= workers or 4 * (os.cpu_count() or 1)) as pool:
+        # a level of subfolders at a time so no thread waits on another
+        while level:
+            # symlinked folders can loop back
+            level = [folder for folder in level if os.path.realpath(folder) not in seen]
+            seen.update(os.path.realpath(folder) for folder in level)
+
+            def list_folder(folder):
+                try:
+                    return _list_folder(folder)
+                except OSError as e:
+                    print(f"Error listing {folder} : {e}")
+                    return []
+
+            next_level = []
+            for folder, items in zip(level, pool.map(list_folder, level)):
+                listings[folder] = items
+                next_level += [item for item in items if isinstance(item, str)]
+            level = next_level
+
+    files = []
+    stack = [iter(listings[folder_path])]
+    while stack:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+        elif not isinstance(item, str):
+            files.append(item)
+        elif item in listings:
+            stack.append(iter(listings[item]))
+
+    with _lock:
+        _cache[key] = (scanned, _folder_mtimes(listings), files)
+    return list(files)
+
+
+def get_files(folder_path, explore= False):
+    """
+    Get all the image file paths within a folder (see scan)
+
+    Args:
+        folder_path (str): folder of images
+        explore (bool, optional): True if including subfolders, default False
+
+    Returns:
+        list[str]
+    """
+    return [entry.path for entry in scan(folder_path, explore)]
+
+
+def count_images(folder_path, explore= False):
+    """
+    Count the images within a folder (see scan)
+
+    Args:
+        folder_path (str): folder of images
+        explore (bool, optional): True if including subfolders, default False
+
+    Returns:
+        int
+    """
+    return len(scan(folder_path, explore))
+
+
+def invalidate(folder_path= None):
+    """
+    Drop cached scans so the next scan lists the folders again
+
+    Args:
+        folder_path (str, optional): drop the scans of this folder and the ones containing it, None for every scan. default None
+    """
+    with _lock:
+        if folder_path is None:
+            _cache.clear()
+            return
+        folder_path = os.path.normpath(os.path.abspath(folder_path))
+        for key in list(_cache):
+            if folder_path == key[0] or folder_path.startswith(key[0].rstrip(os.sep) + os.sep):
+                del _cache[key]
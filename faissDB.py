@@ -0,0 +1,733 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from vectorDB import top_k
+
+
+def index_paths(name, model):
+    """
+    Get the files of a FAISS index
+
+    Args:
+        name (str): name of the index (the collection's uuid)
+        model (str): embedding model of the index, "dino" or "clip"
+
+    Returns:
+        str: path of the index file,
+        str: path of the JSON file mapping the index's ids to image paths
+    """
+    folder = os.path.join("collections", name)
+    return os.path.join(folder, f"{name}_{model}.index"), os.path.join(folder, f"{name}_{model}_paths.json")
+
+
+def manifest_path(name, model):
+    """
+    Get the file storing the size, modified time and (optionally) hash of each image in a FAISS index
+
+    Args:
+        name (str): name of the index (the collection's uuid)
+        model (str): embedding model of the index, "dino" or "clip"
+
+    Returns:
+        str
+    """
+    return os.path.join("collections", name, f"{name}_{model}_manifest.json")
+
+
+def load_manifest(name, model):
+    """
+    Load the manifest of a FAISS index (see manifest_path)
+
+    Args:
+        name (str): name of the index
+        model (str): embedding model of the index, "dino" or "clip"
+
+    Returns:
+        dict: image path -> [size, modified time in ns, hash or None]. empty if the index doesn't have one
+    """
+    if not os.path.exists(manifest_path(name, model)):
+        return {}
+    with open(manifest_path(name, model), "r") as f:
+        return json.load(f)
+
+
+def params_path(name, model):
+    """
+    Get the file storing the type of a FAISS index and its search parameters (see choose_index)
+
+    Args:
+        name (str): name of the index (the collection's uuid)
+        model (str): embedding model of the index, "dino" or "clip"
+
+    Returns:
+        str
+    """
+    return os.path.join("collections", name, f"{name}_{model}_params.json")
+
+
+def load_params(name, model):
+    """
+    Load the parameters of a FAISS index (see choose_index)
+
+    Args:
+        name (str): name of the index
+        model (str): embedding model of the index, "dino" or "clip"
+
+    Returns:
+        dict: empty if the index doesn't have any (indexes made before there were other types are flat)
+    """
+    if not os.path.exists(params_path(name, model)):
+        return {}
+    with open(params_path(name, model), "r") as f:
+        return json.load(f)
+
+
+# collections smaller than this are searched exactly, a flat index is fast enough for them
+FLAT_MAX = 20000
+# collections bigger than this use product quantization unless the target is "recall"
+PQ_MIN = 500000
+# how many more neighbors than asked for are searched for when re-ranking with full precision vectors
+RERANK_FACTOR = 4
+
+def choose_index(n, d, target = "balanced", codes = None, rerank = False):
+    """
+    Pick the type of FAISS index for a collection from its size and a latency/recall target\n
+    "flat" is exact, "ivf" only scans the nprobe clusters closest to the query,
+    and "hnsw" searches a graph (fast with high recall but more memory and slow removals)\n
+    the vectors can be stored as "float32", or compressed as "fp16" (2x less memory), "sq8" (4x) or "pq" (product quantization, ~16x),
+    then re-ranking searches a few more neighbors and sorts them again by their full precision vectors (see save_vectors)
+
+    Args:
+        n (int): number of images in the collection
+        d (int): dimension of the embeddings
+        target (str, optional): "exact" to always search exactly, "recall" to favor recall, "speed" to favor latency and memory,
+            or "balanced". default "balanced"
+        codes (str, optional): "float32", "fp16", "sq8" or "pq", None to pick from the size and target. default None
+        rerank (bool, optional): True to re-rank results with full precision vectors. default False
+
+    Returns:
+        dict: "type", "codes", "rerank", the target and compression asked for and the parameters to make and search the index with ("nlist", "m", "nprobe", "efSearch"),
+            "trained_on" is the collection size the index was made for
+    """
+    if target not in ("exact", "recall", "speed", "balanced"):
+        raise ValueError("Target must be 'exact', 'recall', 'speed' or 'balanced'")
+    if codes not in (None, "float32", "fp16", "sq8", "pq"):
+        raise ValueError("Codes must be 'float32', 'fp16', 'sq8' or 'pq'")
+
+    # what was asked for is kept so updating the index later makes the same choices
+    params = {"target": target, "compression": codes, "rerank": rerank, "trained_on": n}
+    if codes is None:
+        # compress big collections unless the target is exact or recall
+        codes = "pq" if n >= FLAT_MAX and (target == "speed" or (target == "balanced" and n >= PQ_MIN)) else "float32"
+    if codes == "pq" and n < 256 * 39:
+        # not enough images to train the 256 centroids of each sub quantizer
+        codes = "sq8"
+    params["codes"] = codes
+    if codes == "pq":
+        # 8 bit codes for sub vectors of ~8 dimensions, m has to divide d
+        params["m"] = max(m for m in range(1, d // 8 + 1) if d % m == 0)
+
+    if target == "exact" or n < FLAT_MAX:
+        params["type"] = "flat"
+    elif target == "recall":
+        params.update({"type": "hnsw", "M": 32, "efConstruction": 80, "efSearch": 128})
+    else:
+        # ~4 sqrt(n) clusters, with enough points in each to train them
+        nlist = int(min(4 * np.sqrt(n), n // 39))
+        params.update({"type": "ivf", "nlist": nlist, "nprobe": max(nlist // (64 if target == "speed" else 32), 8)})
+    return params
+
+
+def is_lossy(params):
+    """
+    Check if an index's vectors can't be reconstructed exactly
+
+    Args:
+        params (dict): parameters of the index (see choose_index)
+
+    Returns:
+        bool
+    """
+    return params.get("codes", "float32") in ("sq8", "pq")
+
+
+def train_size(params):
+    """
+    Get the number of vectors an index is trained on by build_index
+
+    Args:
+        params (dict): type and parameters of the index (see choose_index)
+
+    Returns:
+        int: 0 if the index doesn't need training
+    """
+    if params["type"] != "ivf" and params.get("codes", "float32") in ("float32", "fp16"):
+        return 0
+    # 64 points per cluster/centroid is plenty, training on all of them is just slower (and they'd all have to be in memory)
+    return max(params.get("nlist", 0), 256) * 64
+
+
+def build_index(params, d, metric, train_vectors = None):
+    """
+    Make an empty FAISS index that can add, remove and reconstruct vectors by id, training it if its type needs to
+
+    Args:
+        params (dict): type and parameters of the index (see choose_index)
+        d (int): dimension of the embeddings
+        metric (int): faiss.METRIC_INNER_PRODUCT or faiss.METRIC_L2
+        train_vectors (numpy.ndarray, optional): float32 vectors to train on, a random sample of them is used. default None
+
+    Returns:
+        faiss.Index, params["trained_vectors"] is set to the number of vectors it was trained on
+    """
+    import faiss
+
+    codes = params.get("codes", "float32")
+    quantizers = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+
+    if params["type"] == "ivf":
+        factory = {"float32": "Flat", "fp16": "SQfp16", "sq8": "SQ8", "pq": f"PQ{params.get('m')}"}[codes]
+        index = faiss.index_factory(d, f"IVF{params['nlist']},{factory}", metric)
+        # IVF indexes take ids directly, the hash table lets them reconstruct and remove by id
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        if params["type"] == "hnsw":
+            if codes == "float32":
+                index = faiss.IndexHNSWFlat(d, params["M"], metric)
+            elif codes == "pq":
+                index = faiss.IndexHNSWPQ(d, params["m"], params["M"], 8, metric)
+            else:
+                index = faiss.IndexHNSWSQ(d, quantizers[codes], params["M"], metric)
+            index.hnsw.efConstruction = params["efConstruction"]
+        elif codes == "pq":
+            index = faiss.IndexPQ(d, params["m"], 8, metric)
+        elif codes in quantizers:
+            index = faiss.IndexScalarQuantizer(d, quantizers[codes], metric)
+        elif metric == faiss.METRIC_INNER_PRODUCT:
+            index = faiss.IndexFlatIP(d)
+        else:
+            index = faiss.IndexFlatL2(d)
+
+        # IndexIDMap2 can reconstruct vectors by id, so searches can reuse them
+        index = faiss.IndexIDMap2(index)
+
+    if not index.is_trained:
+        sample = train_vectors
+        size = train_size(params)
+        if len(sample) > size:
+            sample = sample[np.random.default_rng(0).choice(len(sample), size, replace= False)]
+        index.train(np.ascontiguousarray(sample, dtype= np.float32))
+        params["trained_vectors"] = len(sample)
+
+    apply_params(index, params)
+    return index
+
+
+def undertrained(params, n):
+    """
+    Check if an index was trained on fewer vectors than it would be now (e.g. a run was stopped before the training sample was embedded)
+
+    Args:
+        params (dict): type and parameters of the index (see choose_index and build_index)
+        n (int): number of images in the collection
+
+    Returns:
+        bool
+    """
+    trained = params.get("trained_vectors")
+    # indexes made before this was saved were trained on a full sample
+    return trained is not None and trained < min(train_size(params), n)
+
+
+def apply_params(index, params):
+    """
+    Set the search parameters of a FAISS index (see choose_index)
+
+    Args:
+        index (faiss.Index): the index
+        params (dict): its parameters
+    """
+    import faiss
+
+    space = faiss.ParameterSpace()
+    for key in ("nprobe", "efSearch"):
+        if key in params:
+            space.set_index_parameter(index, key, params[key])
+
+
+def index_ids(index):
+    """
+    Get the ids of every vector in a FAISS index
+
+    Args:
+        index (faiss.Index): an index made by build_index
+
+    Returns:
+        numpy.ndarray: int64 ids
+    """
+    import faiss
+
+    if hasattr(index, "id_map"):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+
+    invlists = faiss.extract_index_ivf(index).invlists
+    ids = [faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+           for l in range(invlists.nlist) if invlists.list_size(l)]
+    return np.concatenate(ids).astype(np.int64) if ids else np.zeros(0, dtype= np.int64)
+
+
+def all_vectors(index):
+    """
+    Get every vector in a FAISS index and its id
+
+    Args:
+        index (faiss.Index): an index made by build_index
+
+    Returns:
+        numpy.ndarray: int64 ids,
+        numpy.ndarray: float32 vectors with shape (len(ids), d), approximate for compressed indexes (see is_lossy)
+    """
+    ids = index_ids(index)
+    if hasattr(index, "id_map"):
+        return ids, index.index.reconstruct_n(0, index.ntotal)
+    return ids, np.stack([index.reconstruct(int(id)) for id in ids]) if len(ids) else np.zeros((0, index.d), dtype= np.float32)
+
+
+def remove_ids(index, ids):
+    """
+    Remove vectors from a FAISS index by id, rebuilding it if its type can't remove (HNSW)
+
+    Args:
+        index (faiss.Index): an index made by build_index
+        ids (numpy.ndarray): int64 ids to remove
+
+    Returns:
+        faiss.Index: the index without the vectors (may be a new index)
+    """
+    import faiss
+
+    if not len(ids) or not index.ntotal:
+        return index
+    try:
+        index.remove_ids(np.asarray(ids, dtype= np.int64))
+        return index
+    except RuntimeError:
+        pass
+
+    kept_ids, vectors = all_vectors(index)
+    keep = ~np.isin(kept_ids, ids)
+    index = faiss.clone_index(index)
+    index.reset()
+    if keep.any():
+        index.add_with_ids(vectors[keep], kept_ids[keep])
+    return index
+
+
+def vectors_path(name, model, params = None):
+    """
+    Get the file storing the full precision embeddings of a FAISS index with compressed vectors, for re-ranking (see choose_index)\n
+    each save writes them to a new file named in the index's params (see IndexManager.save),
+    since the old one can be memory mapped and Windows can't replace a mapped file
+
+    Args:
+        name (str): name of the index (the collection's uuid)
+        model (str): embedding model of the index, "dino" or "clip"
+        params (dict, optional): the index's params (see load_params), None for the name used before they named it. default None
+
+    Returns:
+        str
+    """
+    return os.path.join("collections", name, (params or {}).get("vectors_file", f"{name}_{model}_vectors.npy"))
+
+
+def rerank(query, ids, vectors, k, metric):
+    """
+    Sort the neighbors found by a compressed index again by their full precision vectors
+
+    Args:
+        query (numpy.ndarray): float32 queries with shape (q, d)
+        ids (numpy.ndarray): int64 ids of the neighbors of each query with shape (q, n), -1 for missing
+        vectors (numpy.ndarray): full precision vectors where the vector of id i is at row i (memory mapped)
+        k (int): number of neighbors to keep
+        metric (int): faiss.METRIC_INNER_PRODUCT or faiss.METRIC_L2
+
+    Returns:
+        numpy.ndarray: exact distances with shape (q, k),
+        numpy.ndarray: ids with shape (q, k)
+    """
+    import faiss
+
+    largest = metric == faiss.METRIC_INNER_PRODUCT
+    distances = np.full((len(query), k), -np.inf if largest else np.inf, dtype= np.float32)
+    indices = np.full((len(query), k), -1, dtype= np.int64)
+    for q in range(len(query)):
+        # reading the rows in order is faster for a memory mapped file
+        found = np.sort(ids[q][(ids[q] >= 0) & (ids[q] < len(vectors))])
+        candidates = np.asarray(vectors[found], dtype= np.float32)
+        if largest:
+            exact = candidates @ query[q]
+        else:
+            # faiss L2 distances are squared
+            exact = ((candidates - query[q]) ** 2).sum(axis= 1)
+        order = top_k(exact, k, largest)
+        distances[q, :len(order)] = exact[order]
+        indices[q, :len(order)] = found[order]
+    return distances, indices
+
+
+def file_stamp(paths):
+    """
+    Get the modified time and size of some files to check if they changed
+
+    Args:
+        paths (list[str]): files to check
+
+    Returns:
+        tuple: (modified time, size) or None if missing, for each file
+    """
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def index_nbytes(index):
+    """
+    Estimate the memory used by a FAISS index from the size of its (maybe compressed) vectors, ids and graph links
+
+    Args:
+        index (faiss.Index): the index
+
+    Returns:
+        int: number of bytes
+    """
+    import faiss
+
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    per_vector = 8 # id
+    if hasattr(inner, "hnsw"):
+        per_vector += faiss.downcast_index(inner.storage).code_size + inner.hnsw.nb_neighbors(0) * 4
+    else:
+        per_vector += getattr(inner, "code_size", index.d * 4)
+    return index.ntotal * per_vector
+
+
+def reconstruct(index, id):
+    """
+    Get the vector stored in a FAISS index under an id
+
+    Args:
+        index (faiss.Index): the index
+        id (int): id of the vector
+
+    Returns:
+        numpy.ndarray with shape (1, d) or None if the index can't give back its vectors
+    """
+    import faiss
+
+    try:
+        return index.reconstruct(int(id)).reshape(1, -1)
+    except RuntimeError:
+        pass
+
+    # IndexIDMap (indexes made before IndexIDMap2 was used) can't look up ids, so find where the id was added instead
+    if hasattr(index, "id_map"):
+        positions = np.flatnonzero(faiss.vector_to_array(index.id_map) == id)
+        if len(positions):
+            try:
+                return index.index.reconstruct(int(positions[0])).reshape(1, -1)
+            except RuntimeError:
+                pass
+    return None
+
+
+def _normpath(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+class IndexManager:
+    """
+    Keeps FAISS indexes and their path tables in memory so searches don't read them from disk every time\n
+    an index is reloaded if its files were changed by something else, and the least recently used indexes are closed when they use too much memory
+    """
+    def __init__(self, max_bytes = 2 * 2**30):
+        self.max_bytes = max_bytes
+        # (name, model) -> (index, image paths, file stamp, params, memory mapped full precision vectors or None), least recently used first
+        self.indexes = OrderedDict()
+        self.path_ids = {} # (name, model) -> (image paths, {normalized path -> id}) built the first time find is used
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _files(name, model):
+        # the params name the vectors file, so they change whenever it does
+        return index_paths(name, model) + (params_path(name, model),)
+
+    @staticmethod
+    def _load_vectors(name, model, params):
+        # only the rows of the results are read when re-ranking, so they stay on disk
+        path = vectors_path(name, model, params)
+        return np.load(path, mmap_mode= "r") if params.get("rerank") and os.path.exists(path) else None
+
+    def _entry(self, name, model):
+        """
+        Get everything kept in memory for a FAISS index, loading it if it isn't in memory or its files changed
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+
+        Returns:
+            tuple: index, image paths, file stamp, params, full precision vectors or None
+        """
+        import faiss
+
+        key = (name, model)
+        files = self._files(name, model)
+        with self.lock:
+            entry = self.indexes.get(key)
+            stamp = file_stamp(files)
+            if entry is not None and entry[2] == stamp:
+                self.indexes.move_to_end(key)
+                return entry
+
+            index = faiss.read_index(files[0])
+            with open(files[1], "r") as f:
+                image_paths = json.load(f)
+            # nprobe/efSearch can be tuned in the params file without rewriting the index
+            params = load_params(name, model)
+            apply_params(index, params)
+            vectors = self._load_vectors(name, model, params)
+
+            entry = (index, image_paths, stamp, params, vectors)
+            self.indexes[key] = entry
+            self.indexes.move_to_end(key)
+            self._evict()
+            return entry
+
+    def get(self, name, model):
+        """
+        Get a FAISS index and the image paths its ids map to, loading them if they aren't in memory or their files changed
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+
+        Returns:
+            faiss.Index,
+            list[str]: image paths where the path of id i is at index i (None for removed ids)
+        """
+        return self._entry(name, model)[:2]
+
+    def params(self, name, model):
+        """
+        Get the type and search parameters of a FAISS index (see choose_index)
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+
+        Returns:
+            dict: empty for indexes made before there were other types (flat)
+        """
+        return self._entry(name, model)[3]
+
+    def vectors(self, name, model):
+        """
+        Get the full precision vectors of a FAISS index made with re-ranking
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+
+        Returns:
+            numpy.ndarray (memory mapped) where the vector of id i is at row i, or None if the index isn't re-ranked
+        """
+        return self._entry(name, model)[4]
+
+    def search(self, name, model, query, k):
+        """
+        Search a FAISS index, re-ranking the results with full precision vectors if it was made with them
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+            query (numpy.ndarray): float32 queries with shape (q, d)
+            k (int): number of neighbors
+
+        Returns:
+            numpy.ndarray: distances with shape (q, k),
+            numpy.ndarray: ids with shape (q, k), -1 if less than k were found
+        """
+        index, _, _, params, vectors = self._entry(name, model)
+        if vectors is None:
+            return index.search(query, k)
+
+        _, ids = index.search(query, min(k * RERANK_FACTOR, index.ntotal))
+        return rerank(query, ids, vectors, k, index.metric_type)
+
+    def find(self, name, model, path):
+        """
+        Get the id of an image in a FAISS index
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+            path (str): path of the image
+
+        Returns:
+            int or None if the image isn't in the index
+        """
+        return self.find_many(name, model, [path])[0]
+
+    def find_many(self, name, model, paths):
+        """
+        Get the ids of images in a FAISS index
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+            paths (list[str]): paths of the images
+
+        Returns:
+            list: id of each image or None if it isn't in the index
+        """
+        key = (name, model)
+        _, image_paths = self.get(name, model)
+        with self.lock:
+            cached = self.path_ids.get(key)
+            # the path table is replaced (not changed) when the index is, so it's only rebuilt then
+            if cached is None or cached[0] is not image_paths:
+                cached = (image_paths, {_normpath(p) : id for id, p in enumerate(image_paths) if p is not None})
+                self.path_ids[key] = cached
+        return [cached[1].get(_normpath(path)) for path in paths]
+
+    def exists(self, name, model):
+        """
+        Check if a FAISS index has been made
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+
+        Returns:
+            bool
+        """
+        return all(os.path.exists(path) for path in index_paths(name, model))
+
+    def save(self, name, model, index, image_paths, manifest = None, params = None, vectors = None, cache = True):
+        """
+        Write a FAISS index and its path table, and swap them in for searches\n
+        searches that already got the old index keep using it, new searches get the new one
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+            index (faiss.Index): the index to save
+            image_paths (list[str]): image paths where the path of id i is at index i (None for removed ids)
+            manifest (dict, optional): manifest to save with the index (see load_manifest). default None
+            params (dict, optional): type and search parameters to save with the index (see choose_index). default None
+            vectors (numpy.ndarray, optional): full precision vectors to re-rank with, the vector of id i at row i. default None
+            cache (bool, optional): False to only write the files, for an index that's still being changed (searches load it from the files). default True
+        """
+        import faiss
+
+        key = (name, model)
+        files = self._files(name, model)
+        os.makedirs(os.path.dirname(files[0]), exist_ok= True)
+
+        if vectors is not None:
+            # a new file each time, the old one can be memory mapped (by searches or the update making this index)
+            params = dict(params if params is not None else load_params(name, model))
+            params["vectors_file"] = f"{name}_{model}_vectors_{time.time_ns()}.npy"
+
+        # write to temporary files first so a crash never leaves a half written index
+        faiss.write_index(index, files[0] + ".tmp")
+        with open(files[1] + ".tmp", "w") as f:
+            json.dump(image_paths, f)
+        if manifest is not None:
+            with open(manifest_path(name, model) + ".tmp", "w") as f:
+                json.dump(manifest, f)
+        if params is not None:
+            with open(files[2] + ".tmp", "w") as f:
+                json.dump(params, f)
+        if vectors is not None:
+            with open(vectors_path(name, model, params) + ".tmp", "wb") as f:
+                np.save(f, np.asarray(vectors, dtype= np.float32))
+
+        with self.lock:
+            # the file being replaced might be memory mapped by the old entry
+            self.indexes.pop(key, None)
+
+            os.replace(files[0] + ".tmp", files[0])
+            os.replace(files[1] + ".tmp", files[1])
+            if manifest is not None:
+                os.replace(manifest_path(name, model) + ".tmp", manifest_path(name, model))
+            if vectors is not None:
+                os.replace(vectors_path(name, model, params) + ".tmp", vectors_path(name, model, params))
+            if params is not None:
+                os.replace(files[2] + ".tmp", files[2])
+                self._remove_old_vectors(name, model, params)
+            if not cache:
+                return
+
+            params = load_params(name, model)
+            vectors = self._load_vectors(name, model, params)
+            self.indexes[key] = (index, image_paths, file_stamp(files), params, vectors)
+            self.indexes.move_to_end(key)
+            self._evict()
+
+    @staticmethod
+    def _remove_old_vectors(name, model, params):
+        """
+        Delete the vectors files of a FAISS index that its params don't name
+
+        Args:
+            name (str): name of the index
+            model (str): embedding model of the index, "dino" or "clip"
+            params (dict): the params just saved with the index
+        """
+        folder = os.path.dirname(vectors_path(name, model))
+        current = os.path.basename(vectors_path(name, model, params)) if params.get("rerank") else None
+        prefix = f"{name}_{model}_vectors"
+        for file in os.listdir(folder):
+            if file.startswith(prefix) and file.endswith(".npy") and file != current:
+                try:
+                    os.remove(os.path.join(folder, file))
+                except OSError:
+                    # still mapped by a search on Windows, a later save removes it
+                    pass
+
+    def close(self, name, model = None):
+        """
+        Drop indexes from memory
+
+        Args:
+            name (str): name of the index
+            model (str, optional): embedding model of the index to close, or None to close every model of the index. default None
+        """
+        with self.lock:
+            for key in list(self.indexes.keys()):
+                if key[0] == name and (model is None or key[1] == model):
+                    del self.indexes[key]
+                    self.path_ids.pop(key, None)
+
+    def _evict(self):
+        """
+        Close the least recently used indexes until they fit in self.max_bytes, always keeping the most recent one
+        """
+        total = sum(index_nbytes(entry[0]) for entry in self.indexes.values())
+        while total > self.max_bytes and len(self.indexes) > 1:
+            key, entry = self.indexes.popitem(last= False)
+            self.path_ids.pop(key, None)
+            total -= index_nbytes(entry[0])
+
+
+# shared by everything in the process
+faiss_indexes = IndexManager()
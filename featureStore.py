@@ -0,0 +1,236 @@
+"""features of images stored by a hash of the image file's contents, so an image that's in multiple collections
+(e.g. a pinterest board and the folder it was saved from) only gets its colors and embeddings computed once"""
+
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class FeatureStore:
+    def __init__(self, path = os.path.join("features", "features.sqlite")):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Open the database the first time it's needed
+
+        Returns:
+            sqlite3.Connection
+        """
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok= True)
+            self.conn = sqlite3.connect(self.path, check_same_thread= False)
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS features (
+                                    hash TEXT NOT NULL,
+                                    model TEXT NOT NULL,
+                                    vec BLOB NOT NULL,
+                                    PRIMARY KEY (hash, model))""")
+            # so a model's rows can be counted and trimmed without reading every row (see trim)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS features_model ON features (model)")
+            self.conn.commit()
+        return self.conn
+
+    def get_many(self, model, hashes):
+        """
+        Get the stored features of some files
+
+        Args:
+            model (str): tag of the model that made the features (see models.model_tag)
+            hashes (list[str]): content hashes of the files
+
+        Returns:
+            dict: hash -> float32 numpy.ndarray, only for the hashes that are stored
+        """
+        found = {}
+        hashes = list(hashes)
+        with self.lock:
+            conn = self._connect()
+            # sqlite limits the number of parameters in a query
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                rows = conn.execute(f"SELECT hash, vec FROM features WHERE model = ? AND hash IN ({', '.join('?' * len(chunk))})",
+                                    [model] + chunk)
+                for hash, vec in rows:
+                    found[hash] = np.frombuffer(vec, dtype= np.float32).copy()
+        return found
+
+    def get(self, model, hash):
+        """
+        Get the stored features of a file
+
+        Args:
+            model (str): tag of the model that made the features (see models.model_tag)
+            hash (str): content hash of the file
+
+        Returns:
+            float32 numpy.ndarray or None if not stored
+        """
+        return self.get_many(model, [hash]).get(hash)
+
+    def put_many(self, model, features):
+        """
+        Store features of some files
+
+        Args:
+            model (str): tag of the model that made the features (see models.model_tag)
+            features (dict): content hash -> features (numpy.ndarray)
+        """
+        if not features:
+            return
+
+        rows = [(hash, model, np.asarray(vec, dtype= np.float32).reshape(-1).tobytes()) for hash, vec in features.items()]
+        with self.lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO features (hash, model, vec) VALUES (?, ?, ?)", rows)
+            conn.commit()
+
+    def trim(self, model, max_rows):
+        """
+        Delete the least recently stored features of a model until at most max_rows are left\n
+        storing features again (put_many) counts as storing them recently, since a replaced row gets a new rowid
+
+        Args:
+            model (str): tag of the model that made the features (see models.model_tag)
+            max_rows (int): number of rows to keep
+
+        Returns:
+            int: number of rows deleted
+        """
+        with self.lock:
+            conn = self._connect()
+            count = conn.execute("SELECT COUNT(*) FROM features WHERE model = ?", (model,)).fetchone()[0]
+            if count <= max_rows:
+                return 0
+            conn.execute("""DELETE FROM features WHERE rowid IN (
+                                SELECT rowid FROM features WHERE model = ? ORDER BY rowid LIMIT ?)""", (model, count - max_rows))
+            conn.commit()
+            return count - max_rows
+
+
+class TextEmbeddingCache:
+    """
+    Keeps embeddings of text queries so repeated searches skip the text encoder
+
+    recent queries are kept in memory (least recently used are dropped first) and are also stored in the feature store
+    so they're still cached the next time the app is opened\n
+    at most max_stored queries are kept in the feature store for each model (about 2 KB each for CLIP),
+    the least recently used are deleted first
+    """
+    def __init__(self, store, max_entries = 256, max_stored = 10000):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_stored = max_stored
+        self.embeddings = OrderedDict() # (model tag, normalized query) -> embedding, least recently used first
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query):
+        """
+        Normalize a query so queries that embed the same share an entry (the CLIP tokenizer lowercases and collapses whitespace too)
+
+        Args:
+            query (str): the text query
+
+        Returns:
+            str
+        """
+        return re.sub(r"\s+", " ", query).strip().lower()
+
+    def get(self, model, query, embed):
+        """
+        Get the embedding of a text query, embedding it only if it isn't cached
+
+        Args:
+            model (str): tag of the model that embeds the text (see models.model_tag)
+            query (str): the text query
+            embed (Callable): called with the normalized query to embed it if it isn't cached, returns numpy.ndarray
+
+        Returns:
+            float32 numpy.ndarray with shape (1, d)
+        """
+        return self.get_many(model, [query], lambda queries: np.stack([np.asarray(embed(q)).reshape(-1) for q in queries]))
+
+    def get_many(self, model, queries, embed):
+        """
+        Get the embeddings of many text queries, embedding the ones that aren't cached together
+
+        Args:
+            model (str): tag of the model that embeds the text (see models.model_tag)
+            queries (list[str]): the text queries
+            embed (Callable): called with the list of normalized queries that aren't cached, returns numpy.ndarray with one row per query
+
+        Returns:
+            float32 numpy.ndarray with shape (len(queries), d)
+        """
+        keys = [(model, self.normalize(query)) for query in queries]
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.embeddings:
+                    self.memory_hits += 1
+                    self.embeddings.move_to_end(key)
+                    found[key] = self.embeddings[key]
+
+        # stored under a hash of the text like files are stored under a hash of their contents
+        missing = list(dict.fromkeys(key[1] for key in keys if key not in found))
+        hashes = {query : hashlib.blake2b(query.encode("utf-8"), digest_size= 16).hexdigest() for query in missing}
+        stored = self.store.get_many(model + "_text", hashes.values())
+        used = {}
+        for query in missing:
+            if hashes[query] in stored:
+                self.disk_hits += 1
+                found[(model, query)] = stored[hashes[query]]
+                used[hashes[query]] = stored[hashes[query]]
+
+        missing = [query for query in missing if (model, query) not in found]
+        if missing:
+            self.misses += len(missing)
+            computed = np.asarray(embed(missing), dtype= np.float32).reshape(len(missing), -1)
+            for i, query in enumerate(missing):
+                found[(model, query)] = computed[i]
+                used[hashes[query]] = computed[i]
+
+        if used:
+            # stored queries that were used are stored again so they're the last to be trimmed
+            self.store.put_many(model + "_text", used)
+            if missing:
+                self.store.trim(model + "_text", self.max_stored)
+
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                self.embeddings[key] = np.asarray(found[key], dtype= np.float32).reshape(-1)
+                self.embeddings.move_to_end(key)
+            while len(self.embeddings) > self.max_entries:
+                self.embeddings.popitem(last= False)
+        return np.stack([np.asarray(found[key], dtype= np.float32).reshape(-1) for key in keys])
+
+    def stats(self):
+        """
+        Get the number of hits and misses since the app was opened, for tuning max_entries
+
+        Returns:
+            dict: "memory_hits", "disk_hits", "misses" and "entries" (number of queries in memory)
+        """
+        with self.lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses, "entries": len(self.embeddings)}
+
+    def clear(self):
+        """
+        Drop the queries kept in memory (the ones in the feature store stay)
+        """
+        with self.lock:
+            self.embeddings.clear()
+
+
+# shared by everything in the process
+feature_store = FeatureStore()
+text_embeddings = TextEmbeddingCache(feature_store)
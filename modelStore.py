@@ -0,0 +1,220 @@
+"""local store of the embedding models' weights, so loading them never touches the network or torch.hub's repo checks\n
+the weights are saved once as safetensors files with their sha256 pinned in models/store/manifest.json,
+and loaded by memory mapping the file: the weights are only read from disk as they're used
+and processes loading the same model share the pages"""
+
+import os
+import json
+import struct
+import hashlib
+import threading
+import numpy as np
+
+# safetensors dtype names -> torch dtype names
+DTYPES = {"F64": "float64", "F32": "float32", "F16": "float16", "BF16": "bfloat16",
+          "I64": "int64", "I32": "int32", "I16": "int16", "I8": "int8", "U8": "uint8", "BOOL": "bool"}
+
+_lock = threading.Lock()
+
+
+def store_dir():
+    """
+    Get the folder the weights and their manifest are kept in
+
+    Returns:
+        str
+    """
+    from models import model_dir
+    return os.path.join(model_dir(), "store")
+
+
+def load_manifest():
+    """
+    Get the pinned artifacts
+
+    Returns:
+        dict: model tag (see models.model_tag) -> {"file", "sha256", "size", "mtime_ns", and what the model is built from}
+    """
+    path = os.path.join(store_dir(), "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding= "utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest):
+    path = os.path.join(store_dir(), "manifest.json")
+    with open(path + ".tmp", "w", encoding= "utf-8") as f:
+        json.dump(manifest, f, indent= 4)
+    os.replace(path + ".tmp", path)
+
+
+def file_sha256(path):
+    """
+    Get the sha256 of a file's contents
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def has(tag):
+    """
+    Check if a model's weights are in the store
+
+    Args:
+        tag (str): the model's tag (see models.model_tag)
+
+    Returns:
+        bool
+    """
+    entry = load_manifest().get(tag)
+    return entry is not None and os.path.exists(os.path.join(store_dir(), entry["file"]))
+
+
+def add(tag, module, **info):
+    """
+    Save a model's weights (every parameter and buffer) to the store and pin their checksum
+
+    Args:
+        tag (str): the model's tag (see models.model_tag)
+        module (torch.nn.Module): the loaded model
+        **info: anything else needed to build the model, kept in its manifest entry (must be JSON serializable)
+
+    Returns:
+        dict: the model's manifest entry
+    """
+    from safetensors.torch import save_file
+
+    tensors = {}
+    for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+        # clone so tensors sharing memory are saved separately
+        tensors[name] = tensor.detach().to("cpu").contiguous().clone()
+
+    os.makedirs(store_dir(), exist_ok= True)
+    file = tag + ".safetensors"
+    path = os.path.join(store_dir(), file)
+    save_file(tensors, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    st = os.stat(path)
+    entry = {"file": file, "sha256": file_sha256(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns, **info}
+    with _lock:
+        manifest = load_manifest()
+        manifest[tag] = entry
+        _save_manifest(manifest)
+    return entry
+
+
+def verify(tag= None):
+    """
+    Check the weights in the store against their pinned checksums by reading every byte\n
+    loading only does this when a file's size or modified time changed since it was pinned
+
+    Args:
+        tag (str, optional): the model's tag (see models.model_tag), None to check every model. default None
+
+    Returns:
+        dict: model tag -> True if the file matches its checksum
+    """
+    manifest = load_manifest()
+    results = {}
+    for name, entry in manifest.items():
+        if tag is not None and name != tag:
+            continue
+        path = os.path.join(store_dir(), entry["file"])
+        results[name] = os.path.exists(path) and file_sha256(path) == entry["sha256"]
+    return results
+
+
+def load_tensors(tag):
+    """
+    Memory map a model's weights from the store
+
+    Args:
+        tag (str): the model's tag (see models.model_tag)
+
+    Returns:
+        dict: name -> torch.Tensor backed by the file,
+        dict: the model's manifest entry
+    """
+    import torch
+
+    manifest = load_manifest()
+    if tag not in manifest:
+        raise KeyError(f"{tag} is not in the model store")
+    entry = manifest[tag]
+    path = os.path.join(store_dir(), entry["file"])
+
+    st = os.stat(path)
+    if (st.st_size, st.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+        # touched since it was pinned, so check the contents once and pin the new time
+        if file_sha256(path) != entry["sha256"]:
+            raise ValueError(f"{path} doesn't match its pinned checksum")
+        try:
+            with _lock:
+                manifest = load_manifest()
+                manifest[tag]["mtime_ns"] = st.st_mtime_ns
+                _save_manifest(manifest)
+        except OSError as e:
+            # e.g. the store bundled with the app in a read only install folder, the file is checked again next time
+            print(f"Can't pin the new modified time of {path} : {e}")
+
+    # safetensors layout: 8 byte little endian header length, JSON header, then the tensors' bytes
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    start = 8 + header_size
+
+    # not shared: pages are copy on write, so the file is never changed, but unchanged pages are still shared between processes
+    storage = torch.UntypedStorage.from_file(path, False, st.st_size)
+    tensors = {}
+    for name, info in header.items():
+        dtype = getattr(torch, DTYPES[info["dtype"]])
+        begin, _ = info["data_offsets"]
+        itemsize = torch.empty(0, dtype= dtype).element_size()
+        if (start + begin) % itemsize:
+            # can't view unaligned bytes, read this one
+            from safetensors import safe_open
+            with safe_open(path, framework= "pt") as f:
+                tensors[name] = f.get_tensor(name)
+            continue
+
+        shape = info["shape"]
+        strides = [int(np.prod(shape[i + 1:])) for i in range(len(shape))]
+        tensors[name] = torch.empty(0, dtype= dtype).set_(storage, (start + begin) // itemsize, shape, strides)
+    return tensors, entry
+
+
+def assign(module, tensors):
+    """
+    Replace every parameter and buffer of a model with the given tensors, without copying them
+
+    Args:
+        module (torch.nn.Module): the model, usually made on the meta device so nothing was allocated
+        tensors (dict): name -> torch.Tensor, like load_tensors returns
+    """
+    import torch
+
+    for name, tensor in tensors.items():
+        *path, attr = name.split(".")
+        owner = module.get_submodule(".".join(path))
+        if attr in owner._parameters:
+            owner._parameters[attr] = torch.nn.Parameter(tensor, requires_grad= False)
+        elif attr in owner._buffers:
+            owner._buffers[attr] = tensor
+        else:
+            raise KeyError(f"{name} isn't a parameter or buffer of the model")
+
+    missing = [name for name, tensor in list(module.named_parameters()) + list(module.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise KeyError(f"The model store is missing {', '.join(missing)}")
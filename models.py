@@ -0,0 +1,508 @@
+"""the embedding models are only loaded the first time they're used, so color search never has to import torch or open_clip\n
+they run with PyTorch or with ONNX Runtime (see onnxBackend), which doesn't import torch at all"""
+
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+open_clip_model_name = "ViT-B-32"
+open_clip_pretrained_weights = "laion2b_s34b_b79k"
+
+_loaded = {}
+_locks = {"dino": threading.Lock(), "clip": threading.Lock()}
+
+# how the models are run, see configure
+inference_settings = {
+    "threads": None, # intra-op threads, None for torch's default (number of cores)
+    "interop_threads": None, # inter-op threads, None for torch's default
+    "channels_last": False, # channels last memory format, faster convolutions/patch embeddings on some CPUs
+    "bf16": False, # bfloat16 autocast on CPUs that support it
+    "compile": False, # torch.compile the models (slow first batch)
+    "int8": False, # dynamically quantize the models' Linear layers to int8 on CPU, embeddings get their own tags (see model_tag)
+    # "torch" or "onnx" (ONNX Runtime on the CPU, only threads and interop_threads apply), the app uses onnx when the graphs are bundled with it
+    "backend": "onnx" if hasattr(sys, '_MEIPASS') and os.path.isdir(os.path.join(sys._MEIPASS, 'models', 'onnx')) else "torch",
+}
+# load the models' weights from the local model store (see modelStore), they're added to it the first time they're loaded
+use_store = True
+_encoders = {} # (model, kind, int8) -> (settings they were made with, encoder)
+
+
+def model_dir():
+    """
+    Get the folder the models are stored/cached in, works for dev and for PyInstaller
+
+    Returns:
+        str
+    """
+    if hasattr(sys, '_MEIPASS'):
+        return os.path.join(sys._MEIPASS, 'models')
+    os.makedirs("./models", exist_ok=True)
+    return './models'
+
+
+def model_tag(model, int8= None):
+    """
+    Get a tag naming a model and its weights, so stored features made by different models or versions never get mixed\n
+    embeddings from the int8 quantized models get their own tags
+
+    Args:
+        model (str): "dino", "clip" or "colors" (colors.get_dominant_colors)
+        int8 (bool, optional): True if the embeddings are from the int8 quantized model, None to use inference_settings. default None
+
+    Returns:
+        str
+    """
+    if model in ("dino", "clip"):
+        tag = "dino_vits16" if model == "dino" else f"clip_{open_clip_model_name}_{open_clip_pretrained_weights}"
+        return tag + "_int8" if use_int8(int8) else tag
+    elif model == "colors":
+        return "colors_5"
+    raise ValueError("Model must be 'dino', 'clip' or 'colors'")
+
+
+def embedding_tag(model, int8= None):
+    """
+    Get the tag image embeddings and the indexes made from them are stored under, the model's tag (see model_tag)
+    with "_onnx" added for clip on the onnx backend, whose images are cropped differently (see onnxBackend.clip_transform)\n
+    dino's images are preprocessed the same way on both backends
+
+    Args:
+        model (str): "dino" or "clip"
+        int8 (bool, optional): see model_tag
+
+    Returns:
+        str
+    """
+    tag = model_tag(model, int8)
+    # int8 is torch only so this never comes before "_int8"
+    return tag + "_onnx" if model == "clip" and inference_settings["backend"] == "onnx" else tag
+
+
+def query_tag(model, int8= None):
+    """
+    Get the tag embeddings of query images are stored under, the same as embedding_tag unless queries are preprocessed
+    differently from the images in the indexes (clip on torch, see get_image_encoder)
+
+    Args:
+        model (str): "dino" or "clip"
+        int8 (bool, optional): see model_tag
+
+    Returns:
+        str
+    """
+    tag = embedding_tag(model, int8)
+    return tag + "_query" if model == "clip" and inference_settings["backend"] == "torch" else tag
+
+
+def get_device():
+    """
+    Get the device to run the models on
+
+    Returns:
+        str: "cuda" or "cpu"
+    """
+    if inference_settings["backend"] == "onnx":
+        return 'cpu'
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def _dino_transform():
+    import torch
+    import torchvision.transforms.v2 as tfms
+
+    return tfms.Compose([
+        tfms.Resize(size= (224, 224), interpolation= 1),
+        tfms.ToImage(),
+        tfms.ToDtype(torch.float32, scale=True),
+        # tfms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+
+def _dino_from_store():
+    # the architecture comes from the cached hub repo and the weights from the model store, so nothing is downloaded or checked
+    import torch
+    import modelStore
+
+    tensors, entry = modelStore.load_tensors(model_tag("dino", int8= False))
+    with torch.device("meta"):
+        dino = torch.hub.load(os.path.join(model_dir(), entry["hub_dir"]), 'dino_vits16', source= 'local', pretrained= False)
+    modelStore.assign(dino, tensors)
+    return dino.eval()
+
+
+def get_dino():
+    """
+    Get the DINO model, loading it on the first call. safe to call from multiple threads\n
+    it's loaded from the model store if it's there (see modelStore), otherwise from torch.hub and then added to the store
+
+    Returns:
+        torch.nn.Module: dino_vits16,
+        torchvision.transforms.v2.Compose: transform for its input images
+    """
+    with _locks["dino"]:
+        if "dino" not in _loaded:
+            import torch
+            import modelStore
+
+            tag = model_tag("dino", int8= False)
+            if use_store and modelStore.has(tag):
+                dino = _dino_from_store()
+            else:
+                torch.hub.set_dir(os.path.join(model_dir(), 'torch_hub'))
+                dino = torch.hub.load('facebookresearch/dino:main', 'dino_vits16')
+                if use_store:
+                    try:
+                        modelStore.add(tag, dino, hub_dir= os.path.join('torch_hub', 'facebookresearch_dino_main'))
+                    except Exception as e:
+                        print(f"Error adding dino to the model store : {e}")
+
+            _loaded["dino"] = (dino, _dino_transform())
+        return _loaded["dino"]
+
+
+def _clip_from_store():
+    # built on the meta device so no memory is allocated or initialized for weights that get replaced
+    import torch
+    import open_clip
+    import modelStore
+    from open_clip.transform import PreprocessCfg, image_transform_v2
+
+    tensors, entry = modelStore.load_tensors(model_tag("clip", int8= False))
+    with torch.device("meta"):
+        model = open_clip.model.CLIP(**open_clip.get_model_config(open_clip_model_name))
+    modelStore.assign(model, tensors)
+    model = model.to(get_device()).eval()
+
+    preprocess = PreprocessCfg(**entry["preprocess_cfg"])
+    open_clip.set_model_preprocess_cfg(model, entry["preprocess_cfg"])
+    return model, image_transform_v2(preprocess, is_train= True), image_transform_v2(preprocess, is_train= False)
+
+
+def get_clip():
+    """
+    Get the CLIP model, loading it on the first call. safe to call from multiple threads\n
+    it's loaded from the model store if it's there (see modelStore), otherwise from open_clip's cache and then added to the store
+
+    Returns:
+        open_clip.CLIP: the CLIP model,
+        torchvision.transforms.Compose: transform for its input images (open_clip's training transform, which the indexes were made with),
+        torchvision.transforms.Compose: open_clip's validation transform
+    """
+    with _locks["clip"]:
+        if "clip" not in _loaded:
+            import open_clip
+            import modelStore
+
+            tag = model_tag("clip", int8= False)
+            if use_store and modelStore.has(tag):
+                _loaded["clip"] = _clip_from_store()
+            else:
+                _loaded["clip"] = open_clip.create_model_and_transforms(
+                    open_clip_model_name,
+                    pretrained=open_clip_pretrained_weights,
+                    device=get_device(),
+                    cache_dir=os.path.join(model_dir(), 'openclip')
+                )
+                if use_store:
+                    try:
+                        modelStore.add(tag, _loaded["clip"][0], preprocess_cfg= open_clip.get_model_preprocess_cfg(_loaded["clip"][0]))
+                    except Exception as e:
+                        print(f"Error adding clip to the model store : {e}")
+        return _loaded["clip"]
+
+
+def configure(threads= None, interop_threads= None, channels_last= None, bf16= None, compile= None, int8= None, backend= None):
+    """
+    Set how the embedding models are run, only the given settings are changed (see inference_settings)
+
+    Args:
+        threads (int, optional): number of threads each op runs on. default None (unchanged)
+        interop_threads (int, optional): number of threads running independent ops, can only be set before torch runs anything. default None (unchanged)
+        channels_last (bool, optional): True to use the channels last memory format. default None (unchanged)
+        bf16 (bool, optional): True to run in bfloat16 on CPUs that support it. default None (unchanged)
+        compile (bool, optional): True to torch.compile the models. default None (unchanged)
+        int8 (bool, optional): True to run the int8 quantized models on CPU. default None (unchanged)
+        backend (str, optional): "torch" or "onnx" to run the models with ONNX Runtime. default None (unchanged)
+    """
+    if backend not in (None, "torch", "onnx"):
+        raise ValueError("Backend must be 'torch' or 'onnx'")
+
+    for key, value in (("threads", threads), ("interop_threads", interop_threads), ("channels_last", channels_last),
+                       ("bf16", bf16), ("compile", compile), ("int8", int8), ("backend", backend)):
+        if value is not None:
+            inference_settings[key] = value
+
+    # onnx sessions get their threads when they're made
+    if inference_settings["backend"] == "onnx":
+        return
+    import torch
+
+    if inference_settings["threads"]:
+        torch.set_num_threads(inference_settings["threads"])
+    if inference_settings["interop_threads"]:
+        try:
+            torch.set_num_interop_threads(inference_settings["interop_threads"])
+        except RuntimeError as e:
+            print(f"Can't set inter-op threads after torch has started : {e}")
+
+
+def bf16_supported():
+    """
+    Check if the CPU has native bfloat16 instructions, without them bf16 autocast is slower than float32
+
+    Returns:
+        bool
+    """
+    import torch
+
+    try:
+        return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+    except AttributeError:
+        return False
+
+
+@contextmanager
+def inference():
+    """
+    Context to run the embedding models in: no autograd tracking at all, and bfloat16 autocast if it's on and supported
+    """
+    if inference_settings["backend"] == "onnx":
+        yield
+        return
+    import torch
+
+    use_bf16 = inference_settings["bf16"] and get_device() == "cpu" and bf16_supported()
+    autocast = torch.autocast("cpu", dtype= torch.bfloat16) if use_bf16 else nullcontext()
+    with torch.inference_mode(), autocast:
+        yield
+
+
+def use_int8(int8= None):
+    """
+    Check if the models should run quantized to int8, which only works with torch on CPU
+
+    Args:
+        int8 (bool, optional): True/False to choose, None to use inference_settings. default None
+
+    Returns:
+        bool
+    """
+    if int8 is None:
+        int8 = inference_settings["int8"]
+    return bool(int8) and inference_settings["backend"] == "torch" and get_device() == "cpu"
+
+
+def get_quantized(model):
+    """
+    Get a copy of a model with its Linear layers dynamically quantized to int8 (the weights are stored as int8 and
+    activations are quantized on the fly), made on the first call\n
+    for CLIP this quantizes both the image and text towers
+
+    Args:
+        model (str): "dino" or "clip"
+
+    Returns:
+        torch.nn.Module
+    """
+    import torch
+
+    module = get_dino()[0] if model == "dino" else get_clip()[0]
+    with _locks[model]:
+        if model + "_int8" not in _loaded:
+            quantized = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype= torch.qint8)
+            # open_clip casts its inputs to the dtype of the mlp's weight, which is a method on quantized layers, unless this is set
+            for name, layer in quantized.named_modules():
+                if name.endswith("mlp.c_fc"):
+                    layer.int8_original_dtype = torch.float32
+            _loaded[model + "_int8"] = quantized
+        return _loaded[model + "_int8"]
+
+
+def _encoder(model, kind, int8):
+    """
+    Wrap a model's forward function with the current inference settings
+
+    Args:
+        model (str): "dino" or "clip"
+        kind (str): "image" or "text"
+        int8 (bool): True to use the int8 quantized model
+
+    Returns:
+        Callable: list of preprocessed images or texts -> float32 numpy.ndarray of embeddings
+    """
+    import torch
+
+    key = (model, kind, int8)
+    settings = dict(inference_settings)
+    cached = _encoders.get(key)
+    if cached is not None and cached[0] == settings:
+        return cached[1]
+
+    if int8:
+        module = get_quantized(model)
+    else:
+        module = get_dino()[0] if model == "dino" else get_clip()[0]
+    if model == "dino":
+        forward = module
+    else:
+        forward = module.encode_image if kind == "image" else module.encode_text
+
+    channels_last = settings["channels_last"] and kind == "image"
+    if channels_last:
+        module.to(memory_format= torch.channels_last)
+    if settings["compile"]:
+        forward = torch.compile(forward)
+
+    device = get_device()
+
+    def encode(batch):
+        if kind == "text":
+            import open_clip
+            x = open_clip.tokenize(batch).to(device)
+        else:
+            x = torch.stack([torch.as_tensor(image) for image in batch]).to(device)
+        if channels_last:
+            x = x.contiguous(memory_format= torch.channels_last)
+        # bfloat16 outputs can't be turned into numpy arrays
+        return forward(x).float().cpu().numpy()
+
+    _encoders[key] = (settings, encode)
+    return encode
+
+
+def get_image_encoder(model, int8= None, query= False):
+    """
+    Get a function embedding preprocessed images with an image model, set up with the current inference settings (see configure)\n
+    call it in the inference() context
+
+    Args:
+        model (str): "dino" or "clip"
+        int8 (bool, optional): True to use the int8 quantized model, None to use inference_settings. default None
+        query (bool, optional): True for the transform of query images, which is always deterministic
+            (for clip on torch, open_clip's validation transform instead of the training transform). default False
+
+    Returns:
+        Callable: list of images from the transform -> float32 numpy.ndarray of embeddings with shape (n, d),
+        Callable: transform from PIL.Image to the model's input (for clip, the transform the indexes were made with unless query)
+    """
+    if model not in ("dino", "clip"):
+        raise ValueError("Model must be 'dino' or 'clip'")
+    if inference_settings["backend"] == "onnx":
+        from onnxBackend import image_encoder
+        return image_encoder(model, inference_settings["threads"], inference_settings["interop_threads"])
+
+    if model == "dino":
+        _, transform = get_dino()
+    else:
+        _, train_transform, val_transform = get_clip()
+        transform = val_transform if query else train_transform
+    return _encoder(model, "image", use_int8(int8)), transform
+
+
+def get_text_encoder(int8= None):
+    """
+    Get a function embedding text with CLIP, set up with the current inference settings (see configure)\n
+    call it in the inference() context
+
+    Args:
+        int8 (bool, optional): True to use the int8 quantized model, None to use inference_settings. default None
+
+    Returns:
+        Callable: list of texts -> float32 numpy.ndarray of embeddings
+    """
+    if inference_settings["backend"] == "onnx":
+        from onnxBackend import text_encoder
+        return text_encoder(inference_settings["threads"], inference_settings["interop_threads"])
+    return _encoder("clip", "text", use_int8(int8))
+
+
+def benchmark(models= ("dino", "clip"), configs= None, batch_size= 16, batches= 4):
+    """
+    Measure how many images per second the image models embed with different inference settings,
+    to choose the fastest for a machine (then set it with configure)
+
+    Args:
+        models (tuple[str], optional): models to measure, "dino" and/or "clip". default both
+        configs (list[dict], optional): settings to try (see configure), each on top of the default settings.
+            default None (eager, channels last, bf16 if supported, compiled, int8 and onnx if onnxruntime is installed)
+        batch_size (int, optional): number of images in each batch. default 16
+        batches (int, optional): number of batches timed after a warm up batch. default 4
+
+    Returns:
+        list[dict]: "model", "settings" and "images_per_sec" of each model and config
+    """
+    import numpy as np
+    from importlib.util import find_spec
+
+    if configs is None:
+        configs = [{}, {"channels_last": True}]
+        if bf16_supported():
+            configs.append({"channels_last": True, "bf16": True})
+        configs.append({"channels_last": True, "compile": True})
+        configs.append({"int8": True})
+        if find_spec("onnxruntime") is not None:
+            configs.append({"backend": "onnx"})
+
+    defaults = dict(inference_settings)
+    images = list(np.random.rand(batch_size, 3, 224, 224).astype(np.float32))
+    results = []
+    try:
+        for model in models:
+            for config in configs:
+                inference_settings.update(defaults)
+                configure(**config)
+                encode, _ = get_image_encoder(model)
+                with inference():
+                    # first batch includes compiling and allocating
+                    encode(images)
+                    start = time.perf_counter()
+                    for _ in range(batches):
+                        encode(images)
+                    elapsed = time.perf_counter() - start
+
+                results.append({"model": model, "settings": config, "images_per_sec": batch_size * batches / elapsed})
+                print(f"{model} {config or 'eager'} : {results[-1]['images_per_sec']:.1f} images/sec")
+    finally:
+        inference_settings.update(defaults)
+    return results
+
+
+def warm_up(models= ("dino", "clip"), background= True):
+    """
+    Load models ahead of time so the first search using them doesn't wait
+
+    Args:
+        models (tuple[str], optional): models to load, "dino" and/or "clip". default both
+        background (bool, optional): True to load in a new thread and return immediately. default True
+
+    Returns:
+        threading.Thread or None: the thread loading the models if background is True
+    """
+    def load():
+        for model in models:
+            try:
+                if inference_settings["backend"] == "onnx":
+                    get_image_encoder(model)
+                    if model == "clip":
+                        get_text_encoder()
+                elif model == "dino":
+                    get_dino()
+                elif model == "clip":
+                    get_clip()
+            except Exception as e:
+                print(f"Error loading {model} : {e}")
+
+    if not background:
+        load()
+        return None
+
+    thread = threading.Thread(target= load, name= "model warm up", daemon= True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -13,9 +13,11 @@ from PyQt5.QtGui import QPixmap, QImage, QColor, QPainter, QFont
 from PyQt5.QtCore import Qt, QRectF, QElapsedTimer, QTimer, pyqtSignal, QThread
 
 from view import CustomGraphicsView
-from vectorDB import VectorDB
-from accessDBs import add_color, search_color, add_visual, search_visual, search_clip
+from vectorDB import color_dbs
+from accessDBs import add_color, search_color, add_visual, search_visual, search_clip, search_clip_image
 from colors import get_dominant_colors, show_palette
+from models import warm_up
+from discovery import IMAGE_FILTER
 from colorpicker import colorPicker
 import vcolorpicker
 
@@ -28,7 +30,11 @@ class ImageMosaicApp(QMainWindow):
         self.landing_page = None
         self.uuid = uuid
         self.collection_data = collection_data
-        self.color_db = VectorDB.get_DB(self.uuid)
+        self.color_db = color_dbs.get(self.uuid)
+        # load the models this collection searches with in the background so the first search doesn't wait as long
+        models = [model for model in ("dino", "clip") if collection_data.get(model, False)]
+        if models:
+            warm_up(models)
         self.setWindowTitle(f"Mosaic View - {collection_data["name"]}")
         self.setGeometry(100, 100, 1400, 768)
 
@@ -377,8 +383,7 @@ class ImageMosaicApp(QMainWindow):
         # Add CLIP text search if supported
         if self.collection_data.get("clip", False):
             search_types.append("Text Search (CLIP)")
-            # just gonna let dino do image search
-            # search_types.append("Image Content Search (CLIP)")
+            search_types.append("Image Content Search (CLIP)")
 
         # Add Visual Similarity if DINO supported  
         if self.collection_data.get("dino", False):
@@ -500,7 +505,7 @@ class ImageMosaicApp(QMainWindow):
         """Select query image for similarity search"""
         file_path, _ = QFileDialog.getOpenFileName(
             self, "Select Query Image", "", 
-            "Image Files (*.png *.jpg *.jpeg *.bmp *.gif *.tiff)"
+            IMAGE_FILTER
         )
         if file_path:
             self.query_image_path = file_path
@@ -644,6 +649,7 @@ class ImageMosaicApp(QMainWindow):
         class IndexCreationWorker(QThread):
             progress = pyqtSignal(int)
             finished = pyqtSignal()
+            cancelled = pyqtSignal()
             error = pyqtSignal(str)
             
             def __init__(self, key, folder, explore, index_type):
@@ -658,11 +664,16 @@ class ImageMosaicApp(QMainWindow):
                     def progress_callback(current):
                         self.progress.emit(current)
                     
-                    add_visual(self.key, self.folder, self.explore, 
+                    # stops between batches when clearMosaic asks it to, the next run continues from there
+                    done = add_visual(self.key, self.folder, self.explore, 
                             model=self.index_type, 
-                            progress=progress_callback)
-                            
-                    self.finished.emit()
+                            progress=progress_callback,
+                            cancel=self.isInterruptionRequested)
+
+                    if done:
+                        self.finished.emit()
+                    else:
+                        self.cancelled.emit()
                 except Exception as e:
                     self.error.emit(str(e))
         
@@ -706,6 +717,7 @@ class ImageMosaicApp(QMainWindow):
         
         self.index_worker.progress.connect(on_progress_value)
         self.index_worker.finished.connect(on_finished)
+        self.index_worker.cancelled.connect(progress_dialog.close)
         self.index_worker.error.connect(on_error)
         self.index_worker.start()
 
@@ -717,7 +729,7 @@ class ImageMosaicApp(QMainWindow):
         
         if self.collection_data.get("clip", False):
             search_types.append("Text Search (CLIP)")
-            # search_types.append("Image Content Search (CLIP)")
+            search_types.append("Image Content Search (CLIP)")
             
             # Remove CLIP index creation button if it exists
             if hasattr(self, 'create_clip_btn') and self.create_clip_btn:
@@ -757,7 +769,7 @@ class ImageMosaicApp(QMainWindow):
         # Stop any active worker threads
         if hasattr(self, 'index_worker') and self.index_worker:
             if self.index_worker.isRunning():
-                self.index_worker.terminate()
+                self.index_worker.requestInterruption()
                 self.index_worker.wait()
 
         # Clear scene
@@ -869,7 +881,7 @@ class ImageMosaicApp(QMainWindow):
                 
             elif search_type == "Image Content Search (CLIP)":
                 if hasattr(self, 'query_image_path') and self.query_image_path:
-                    images = search_clip(database, query_image_path=self.query_image_path, k=num_images)
+                    images = search_clip_image(name=database, file_path=self.query_image_path, k=num_images)
                 else:
                     print("No reference image selected for image search")
                     return
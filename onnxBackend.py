@@ -0,0 +1,347 @@
+"""runs the embedding models with ONNX Runtime instead of PyTorch, so the app doesn't have to import torch at all\n
+the models are exported to ONNX once (which does need torch and open_clip) and the graphs are kept in models/onnx,
+images are preprocessed with PIL and numpy and text is tokenized with a copy of CLIP's tokenizer"""
+
+import os
+import gzip
+import html
+import shutil
+import threading
+import numpy as np
+from functools import lru_cache
+from PIL import Image
+
+# same normalization as open_clip (OPENAI_DATASET_MEAN and OPENAI_DATASET_STD)
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype= np.float32).reshape(3, 1, 1)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype= np.float32).reshape(3, 1, 1)
+CONTEXT_LENGTH = 77
+VOCAB = "bpe_simple_vocab_16e6.txt.gz"
+
+_sessions = {} # path -> (threads, interop threads, onnxruntime.InferenceSession)
+_lock = threading.Lock()
+
+
+def onnx_dir():
+    """
+    Get the folder the exported graphs and the tokenizer's vocabulary are kept in
+
+    Returns:
+        str
+    """
+    from models import model_dir
+    return os.path.join(model_dir(), "onnx")
+
+
+def graph_path(model, kind):
+    """
+    Get the path of a model's exported graph
+
+    Args:
+        model (str): "dino" or "clip"
+        kind (str): "image" or "text" (clip only)
+
+    Returns:
+        str
+    """
+    from models import model_tag
+    return os.path.join(onnx_dir(), f"{model_tag(model, int8= False)}_{kind}.onnx")
+
+
+def export(model, kind):
+    """
+    Export a model to ONNX with PyTorch, with a dynamic batch size\n
+    exporting CLIP's text encoder also copies the tokenizer's vocabulary next to the graphs
+
+    Args:
+        model (str): "dino" or "clip"
+        kind (str): "image" or "text" (clip only)
+
+    Returns:
+        str: path of the exported graph
+    """
+    import torch
+    from models import get_dino, get_clip
+
+    module = get_dino()[0] if model == "dino" else get_clip()[0]
+    device = next(module.parameters()).device
+
+    class Encoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.module = module
+
+        def forward(self, x):
+            if model == "dino":
+                return self.module(x)
+            return self.module.encode_image(x) if kind == "image" else self.module.encode_text(x)
+
+    os.makedirs(onnx_dir(), exist_ok= True)
+    if kind == "text":
+        import open_clip
+        shutil.copyfile(open_clip.tokenizer.default_bpe(), os.path.join(onnx_dir(), VOCAB))
+        example = torch.as_tensor(tokenize(["a photo of a cat", "a painting"])).to(device)
+    else:
+        example = torch.rand(2, 3, 224, 224, device= device)
+
+    path = graph_path(model, kind)
+    module.eval()
+    with torch.inference_mode():
+        torch.onnx.export(Encoder(), (example,), path + ".tmp", input_names= ["input"], output_names= ["embedding"],
+                          dynamic_axes= {"input": {0: "batch"}, "embedding": {0: "batch"}}, opset_version= 17)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def get_session(model, kind, threads= None, interop_threads= None):
+    """
+    Get an ONNX Runtime session running a model on the CPU, exporting the model the first time
+
+    Args:
+        model (str): "dino" or "clip"
+        kind (str): "image" or "text" (clip only)
+        threads (int, optional): number of threads each op runs on, None for the number of cores. default None
+        interop_threads (int, optional): number of threads running independent ops, None for onnxruntime's default. default None
+
+    Returns:
+        onnxruntime.InferenceSession
+    """
+    import onnxruntime as ort
+
+    path = graph_path(model, kind)
+    with _lock:
+        cached = _sessions.get(path)
+        if cached is not None and cached[:2] == (threads, interop_threads):
+            return cached[2]
+
+        if not os.path.exists(path):
+            export(model, kind)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or 0
+        options.inter_op_num_threads = interop_threads or 0
+        session = ort.InferenceSession(path, sess_options= options, providers= ["CPUExecutionProvider"])
+        _sessions[path] = (threads, interop_threads, session)
+        return session
+
+
+def dino_transform(image):
+    """
+    Preprocess an image for DINO like models.get_dino's transform (module level so process pools can pickle it)
+
+    Args:
+        image (PIL.Image): RGB image
+
+    Returns:
+        float32 numpy.ndarray with shape (3, 224, 224)
+    """
+    image = image.resize((224, 224), Image.LANCZOS)
+    return (np.asarray(image, dtype= np.float32) / 255).transpose(2, 0, 1)
+
+
+def clip_transform(image):
+    """
+    Preprocess an image for CLIP (module level so process pools can pickle it)\n
+    the indexes were made with open_clip's training transform, which crops 90 to 100% of the image at random,
+    this takes the whole image instead (center cropped to an aspect ratio between 3:4 and 4:3 like its fallback)
+
+    Args:
+        image (PIL.Image): RGB image
+
+    Returns:
+        float32 numpy.ndarray with shape (3, 224, 224)
+    """
+    width, height = image.size
+    ratio = min(max(width / height, 3 / 4), 4 / 3)
+    if width / height > ratio:
+        crop_width, crop_height = round(height * ratio), height
+    else:
+        crop_width, crop_height = width, round(width / ratio)
+    left, top = (width - crop_width) // 2, (height - crop_height) // 2
+
+    image = image.resize((224, 224), Image.BICUBIC, box= (left, top, left + crop_width, top + crop_height))
+    array = (np.asarray(image, dtype= np.float32) / 255).transpose(2, 0, 1)
+    return (array - CLIP_MEAN) / CLIP_STD
+
+
+def image_encoder(model, threads= None, interop_threads= None):
+    """
+    Get a function embedding preprocessed images with ONNX Runtime
+
+    Args:
+        model (str): "dino" or "clip"
+        threads, interop_threads: see get_session
+
+    Returns:
+        Callable: list of images from the transform -> float32 numpy.ndarray of embeddings,
+        Callable: transform from PIL.Image to the model's input (dino_transform or clip_transform)
+    """
+    session = get_session(model, "image", threads, interop_threads)
+
+    def encode(batch):
+        images = np.stack([np.asarray(image, dtype= np.float32) for image in batch])
+        return session.run(None, {"input": images})[0].astype(np.float32)
+
+    return encode, dino_transform if model == "dino" else clip_transform
+
+
+def text_encoder(threads= None, interop_threads= None):
+    """
+    Get a function embedding text with CLIP's text encoder in ONNX Runtime
+
+    Args:
+        threads, interop_threads: see get_session
+
+    Returns:
+        Callable: list of texts -> float32 numpy.ndarray of embeddings
+    """
+    session = get_session("clip", "text", threads, interop_threads)
+
+    def encode(texts):
+        return session.run(None, {"input": tokenize(texts)})[0].astype(np.float32)
+
+    return encode
+
+
+# CLIP's byte pair encoding tokenizer (the same as open_clip.tokenize), so text can be tokenized without importing torch
+
+
+@lru_cache()
+def _bytes_to_unicode():
+    # printable unicode characters for every byte, so the merges never see whitespace or control characters
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+def _pairs(word):
+    return {(word[i], word[i + 1]) for i in range(len(word) - 1)}
+
+
+class Tokenizer:
+    def __init__(self, vocab_path):
+        import regex
+
+        merges = gzip.open(vocab_path).read().decode("utf-8").split("\n")
+        merges = [tuple(merge.split()) for merge in merges[1:49152 - 256 - 2 + 1]]
+        vocab = list(_bytes_to_unicode().values())
+        vocab = vocab + [v + "</w>" for v in vocab] + ["".join(merge) for merge in merges] + ["<start_of_text>", "<end_of_text>"]
+
+        self.byte_encoder = _bytes_to_unicode()
+        self.encoder = dict(zip(vocab, range(len(vocab))))
+        self.bpe_ranks = dict(zip(merges, range(len(merges))))
+        self.cache = {"<start_of_text>": "<start_of_text>", "<end_of_text>": "<end_of_text>"}
+        self.pattern = regex.compile(r"""<start_of_text>|<end_of_text>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", regex.IGNORECASE)
+        self.sot = self.encoder["<start_of_text>"]
+        self.eot = self.encoder["<end_of_text>"]
+
+    def bpe(self, token):
+        """
+        Merge the characters of a word into the longest known pieces
+
+        Args:
+            token (str): the word, as byte characters
+
+        Returns:
+            str: the pieces separated by spaces
+        """
+        if token in self.cache:
+            return self.cache[token]
+
+        word = tuple(token[:-1]) + (token[-1] + "</w>",)
+        pairs = _pairs(word)
+        if not pairs:
+            return token + "</w>"
+
+        while True:
+            bigram = min(pairs, key= lambda pair: self.bpe_ranks.get(pair, float("inf")))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            merged = []
+            i = 0
+            while i < len(word):
+                if first not in word[i:]:
+                    merged.extend(word[i:])
+                    break
+                j = word.index(first, i)
+                merged.extend(word[i:j])
+                i = j
+                if i < len(word) - 1 and word[i + 1] == second:
+                    merged.append(first + second)
+                    i += 2
+                else:
+                    merged.append(word[i])
+                    i += 1
+            word = tuple(merged)
+            if len(word) == 1:
+                break
+            pairs = _pairs(word)
+
+        self.cache[token] = " ".join(word)
+        return self.cache[token]
+
+    def encode(self, text):
+        """
+        Tokenize a text
+
+        Args:
+            text (str): the text
+
+        Returns:
+            list[int]: the token ids, without the start and end tokens
+        """
+        import ftfy
+        import regex
+
+        text = ftfy.fix_text(text)
+        text = html.unescape(html.unescape(text)).strip()
+        text = regex.sub(r"\s+", " ", text).strip().lower()
+
+        tokens = []
+        for token in self.pattern.findall(text):
+            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+            tokens.extend(self.encoder[piece] for piece in self.bpe(token).split(" "))
+        return tokens
+
+
+@lru_cache()
+def get_tokenizer():
+    """
+    Get CLIP's tokenizer, loading its vocabulary on the first call (it's copied next to the graphs when the text encoder is exported)
+
+    Returns:
+        Tokenizer
+    """
+    path = os.path.join(onnx_dir(), VOCAB)
+    if not os.path.exists(path):
+        import open_clip
+        path = open_clip.tokenizer.default_bpe()
+    return Tokenizer(path)
+
+
+def tokenize(texts):
+    """
+    Tokenize texts for CLIP's text encoder like open_clip.tokenize, texts that are too long are cut off
+
+    Args:
+        texts (list[str]): the texts
+
+    Returns:
+        int64 numpy.ndarray with shape (len(texts), 77)
+    """
+    tokenizer = get_tokenizer()
+    result = np.zeros((len(texts), CONTEXT_LENGTH), dtype= np.int64)
+    for i, text in enumerate(texts):
+        tokens = [tokenizer.sot] + tokenizer.encode(text) + [tokenizer.eot]
+        if len(tokens) > CONTEXT_LENGTH:
+            tokens = tokens[:CONTEXT_LENGTH]
+            tokens[-1] = tokenizer.eot
+        result[i, :len(tokens)] = tokens
+    return result
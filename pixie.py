@@ -13,6 +13,8 @@ from PyQt5.QtCore import Qt, QSize, pyqtSignal, QThread, QTimer
 from uuid import uuid4
 from datetime import datetime
 from pins import download_board
+from discovery import count_images, IMAGE_FILTER
+from watcher import CollectionWatchers
 
 
 def resource_path(relative_path):
@@ -168,7 +170,7 @@ class CollectionThumbnail(QFrame):
             self,
             "Select New Thumbnail",
             self.collection_data["folder"],
-            "Image Files (*.png *.jpg *.jpeg *.bmp *.gif *.tiff)"
+            IMAGE_FILTER
         )
         
         if file_path:
@@ -187,6 +189,11 @@ class CollectionThumbnail(QFrame):
             with open('collections.json', 'w') as f:
                 json.dump(collections, f, indent=2)
             
+            # let go of the DBs' memory mapped and loaded files before deleting them
+            from vectorDB import color_dbs
+            from faissDB import faiss_indexes
+            color_dbs.close(self.uuid)
+            faiss_indexes.close(self.uuid)
             shutil.rmtree(os.path.join("collections", self.uuid))
 
             self.collection_updated.emit()
@@ -635,7 +642,7 @@ class CreateCollectionDialog(QDialog):
             self, 
             "Select Thumbnail Image", 
             self.selected_folder if self.selected_folder else "", 
-            "Image Files (*.png *.jpg *.jpeg *.bmp *.gif *.tiff)"
+            IMAGE_FILTER
         )
         if file_path:
             self.selected_thumbnail = file_path
@@ -643,20 +650,12 @@ class CreateCollectionDialog(QDialog):
             
     def updateFolderStatus(self):
         if self.selected_folder:
-            # Count image files in folder
-            image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'}
-            image_count = 0
-            
-            if self.subfolders_checkbox.isChecked():
-                for root, dirs, files in os.walk(self.selected_folder):
-                    for file in files:
-                        if os.path.splitext(file.lower())[1] in image_extensions:
-                            image_count += 1
-            else:
-                for file in os.listdir(self.selected_folder):
-                    if os.path.isfile(os.path.join(self.selected_folder, file)):
-                        if os.path.splitext(file.lower())[1] in image_extensions:
-                            image_count += 1
+            # Count image files in folder, the scan is cached so creating the collection right after doesn't list it again
+            try:
+                image_count = count_images(self.selected_folder, self.subfolders_checkbox.isChecked())
+            except OSError as e:
+                print(f"Error counting images: {e}")
+                image_count = 0
             
             if image_count > 0:
                 self.folder_status_label.setText(f"✓ Found {image_count} images")
@@ -770,6 +769,7 @@ class CreateCollectionDialog(QDialog):
 
 class CollectionsLandingPage(QMainWindow):
     """Main landing page for managing collections"""
+    collection_changed = pyqtSignal(str)
     
     def __init__(self):
         super().__init__()
@@ -782,6 +782,11 @@ class CollectionsLandingPage(QMainWindow):
         # Collections data
         self.collections = {}
         self.collections_file = "collections.json"
+
+        # keeps the indexes and image counts up to date as the collections' folders change
+        # watchers update from their own threads so the signal brings the reload back to this one
+        self.watchers = CollectionWatchers(self.collections_file, on_updated= self.collection_changed.emit)
+        self.collection_changed.connect(lambda uuid: self.loadCollections())
         
         self.setupUI()
         self.loadCollections()
@@ -919,6 +924,7 @@ class CollectionsLandingPage(QMainWindow):
             
         self.sortCollections(self.sort_combo.currentText())
         self.updateCollectionsDisplay()
+        self.watchers.sync(self.collections)
         
     def saveCollections(self):
         """Save collections to JSON file"""
@@ -927,6 +933,7 @@ class CollectionsLandingPage(QMainWindow):
                 json.dump(self.collections, f, indent=4)
         except Exception as e:
             print(f"Error saving collections: {e}")
+        self.watchers.sync(self.collections)
             
     def updateCollectionsDisplay(self):
         """Update the display of collections"""
@@ -1060,21 +1067,11 @@ class CollectionsLandingPage(QMainWindow):
         self.index_worker.start()
             
     def countImagesInFolder(self, folder, include_subfolders):
-        """Count image files in a folder"""
-        image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'}
+        """Count image files in a folder, the same ones that get indexed (see discovery.scan)"""
         count = 0
         
         try:
-            if include_subfolders:
-                for root, dirs, files in os.walk(folder):
-                    for file in files:
-                        if os.path.splitext(file.lower())[1] in image_extensions:
-                            count += 1
-            else:
-                for file in os.listdir(folder):
-                    if os.path.isfile(os.path.join(folder, file)):
-                        if os.path.splitext(file.lower())[1] in image_extensions:
-                            count += 1
+            count = count_images(folder, include_subfolders)
         except Exception as e:
             print(f"Error counting images: {e}")
             
@@ -1115,6 +1112,8 @@ def main():
 
     window = CollectionsLandingPage()
     window.showMaximized()
+    # don't wait for an index update to finish before closing
+    app.aboutToQuit.connect(lambda: window.watchers.stop(wait= False))
 
     class ImportThread(QThread):
         finished = pyqtSignal(object)
@@ -1130,7 +1129,7 @@ def main():
             except Exception as e:
                 self.error.emit(str(e))
 
-    progress = QProgressDialog("Loading models...", None, 0, 0, parent=window)
+    progress = QProgressDialog("Loading...", None, 0, 0, parent=window)
     progress.setWindowTitle("Loading")
     progress.setWindowModality(Qt.WindowModal)
     progress.setCancelButton(None)  # Remove cancel button
@@ -1164,7 +1163,7 @@ def main():
 
     def on_import_error(error_msg):
         progress.close()
-        QMessageBox.critical(window, "Error", f"Failed to load models: {error_msg}")
+        QMessageBox.critical(window, "Error", f"Failed to load: {error_msg}")
         sys.exit(1)
 
     import_thread = ImportThread()  
@@ -1,9 +1,15 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+import os
+from glob import glob
 from PyInstaller.utils.hooks import collect_data_files
 
+# every graph and the tokenizer's vocabulary exported (see onnxBackend), so the app never needs torch or open_clip
+onnx_only = all(glob(os.path.join('models/onnx', pattern)) for pattern in
+                ('dino_*_image.onnx', 'clip_*_image.onnx', 'clip_*_text.onnx', 'bpe_simple_vocab_16e6.txt.gz'))
+
 # Collect data files from open_clip
-datas = collect_data_files('open_clip')
+datas = [] if onnx_only else collect_data_files('open_clip')
 
 # Add the assets folder
 datas += [
@@ -12,16 +18,26 @@ datas += [
     ('assets/pixie.ico', 'assets')
 ]
 
+# exported ONNX graphs (see onnxBackend), the app runs them with ONNX Runtime instead of torch when they're bundled
+if os.path.isdir('models/onnx'):
+    datas += [('models/onnx', 'models/onnx')]
+# pinned model weights and the hub code dino is built from (see modelStore), so the app loads the models offline
+# (only torch loads them)
+if os.path.isdir('models/store') and not onnx_only:
+    datas += [('models/store', 'models/store')]
+if os.path.isdir('models/torch_hub/facebookresearch_dino_main') and not onnx_only:
+    datas += [('models/torch_hub/facebookresearch_dino_main', 'models/torch_hub/facebookresearch_dino_main')]
+
 a = Analysis(
     ['pixie.py'],
     pathex=[],
     binaries=[],
     datas=datas,
-    hiddenimports=['open_clip'],
+    hiddenimports=[] if onnx_only else ['open_clip'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=['torch', 'torchvision', 'open_clip', 'timm'] if onnx_only else [],
     noarchive=False,
     optimize=0,
 )
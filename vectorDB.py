@@ -1,64 +1,188 @@
 import numpy as np
 import colors
 import os
+import sys
 import json
-from tqdm import tqdm
+import threading
+from collections import OrderedDict
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        """
-        Converts numpy.ndarray to list for encoding into a JSON
+
+def top_k(distances, k, largest = False):
+    """
+    Get the indices of the k smallest (or largest) distances in order, without sorting all of them
+
+    Args:
+        distances (numpy.ndarray): 1D array of distances
+        k (int): number of indices to return, -1 for all of them
+        largest (bool, optional): True to get the largest distances (e.g. for similarities). default False
+
+    Returns:
+        numpy.ndarray of indices sorted by distance
+    """
+    d = -np.asarray(distances) if largest else np.asarray(distances)
+    if k < 0 or k >= len(d):
+        return np.argsort(d, kind= "stable")
+    if k == 0:
+        return np.zeros(0, dtype= np.int64)
+
+    # O(N) partition so only the k winners get sorted
+    idx = np.argpartition(d, k - 1)[:k]
+    return idx[np.argsort(d[idx], kind= "stable")]
+
+
+class VectorDB:
+    # arrays saved to ./collections/self.name/self.name_color_{array}.npy
+    ARRAYS = ("rgb", "freqs", "counts", "features")
+    # compact the log into the main files once it has this many vectors per vector in the DB
+    COMPACT_RATIO = 0.25
+
+    def __init__(self, name, num_colors = 5):
+        self.name = name
+        self.num_colors = num_colors
+        self.size = 0
+
+        # every palette lives in one row of these contiguous arrays instead of its own numpy array
+        # rows past self.size are spare capacity so adding one at a time doesn't copy everything
+        self.rgb = np.zeros((0, num_colors, 3), dtype= np.uint8)
+        self.freqs = np.zeros((0, num_colors), dtype= np.float32)
+        self.counts = np.zeros(0, dtype= np.uint8) # number of real (not padded) colors in each row
+        # LAB, HSV and normalized frequencies of each color (see colors.palette_features)
+        # so searching only has to convert the query's colors
+        self.features = np.zeros((0, num_colors, 7), dtype= np.float32)
+
+        self.paths = [] # row -> id
+        self.rows = {} # id -> row
+
+        # vectors added or removed since the last save are appended to ./collections/self.name/self.name_color_log.jsonl
+        # so saving only writes what changed, and save_DB folds the log back into the main files
+        self.unflushed = [] # ids added since the last flush
+        self.unflushed_removed = [] # ids removed since the last flush
+        self.log_size = 0 # number of adds and removes in the log file
+        self.lock = threading.RLock()
+        self.disk_stamp = None # VectorDB.file_stamp of the files this DB was last loaded from or saved to
+
+    def _reserve(self, n):
         """
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return super().default(obj)
+        Grow the arrays so they can hold at least n rows
 
-class NumpyDecoder(json.JSONDecoder):
-    def __init__(self, *args, **kwargs):
-        super().__init__(object_hook=self.object_hook, *args, **kwargs)
-    def object_hook(self, obj):
+        Args:
+            n (int): number of rows needed
         """
-        Converts lists back into NumPy arrays if applicable.
+        capacity = len(self.counts)
+        # memory mapped arrays from get_DB are read only so they get copied into memory before changing
+        if n <= capacity and self.counts.flags.writeable:
+            return
+
+        if n > capacity:
+            capacity = max(n, capacity * 2, 64)
+        for attr in self.ARRAYS:
+            old = getattr(self, attr)
+            new = np.zeros((capacity,) + old.shape[1:], dtype= old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, attr, new)
+
+    def _row(self, id):
         """
-        for key, value in obj.items():
-            if isinstance(value, list):
-                obj[key] = np.array(value)
-            elif isinstance(value, dict):
-                obj[key] = self.object_hook(value)
-        return obj
-    
+        Get the row of an id, adding a new row if the id isn't in the database
 
-class VectorDB:
-    def __init__(self, name, vector_data = {}, vector_index = {}):
-        self.name = name
-        self.vector_data = vector_data
-        self.vector_index = vector_index
+        Args:
+            id (str or int): unique id for the vector
+
+        Returns:
+            int
+        """
+        row = self.rows.get(id)
+        if row is None:
+            self._reserve(self.size + 1)
+            row = self.size
+            self.size += 1
+            if isinstance(id, str):
+                id = sys.intern(id) # lots of paths share the same folders
+            self.paths.append(id)
+            self.rows[id] = row
+        return row
 
-    def add_vector(self, id, vec):
+    def add_vector(self, id, vec, features = None):
         """
         Adds a vector to database
 
         Args:
             id (str or int): unique id for the vector
             vec (numpy.ndarray): the vector to be stored
+            features (numpy.ndarray, optional): precomputed colors.palette_features of the vector, computed if None. default None
         """
-        self.vector_data[id] = vec
-        self.vector_index[id] = {}
-        # if you want to update all the vector distances every add
-        # self.update_index(id)
+        self.add_vectors([id], [vec], None if features is None else [features])
 
 
-    def add_vectors(self, ids, vecs):
+    def add_vectors(self, ids, vecs, features = None):
         """
         Adds multiple vectors to database
 
         Args:
             ids (list or numpy.ndarray): ids for each respective vector
             vecs (list or numpy.ndarray): vectors for each respective id
+            features (list or numpy.ndarray, optional): precomputed colors.palette_features for each respective vector,
+                computed if None. default None
         """
-        for id, vec in zip(ids, vecs):
-            self.add_vector(id, vec)
+        if len(ids) == 0:
+            return
 
+        palettes = colors.stack_palettes(vecs, self.num_colors)
+        if features is None:
+            features = colors.palette_features(palettes)
+        else:
+            features = colors.stack_palettes(features, self.num_colors, width= 7)
+
+        with self.lock:
+            self._reserve(self.size) # make sure memory mapped arrays are writable before changing existing rows
+            rows = [self._row(id) for id in ids]
+            self.rgb[rows] = palettes[..., :3]
+            self.freqs[rows] = palettes[..., 3]
+            self.counts[rows] = np.count_nonzero(palettes[..., 3] > 0, axis= 1)
+            self.features[rows] = features
+            self.unflushed.extend(ids)
+
+
+    def remove_vectors(self, ids):
+        """
+        Remove vectors from the database, the last row is moved into each removed row so the arrays stay contiguous
+
+        Args:
+            ids (list): ids of the vectors to remove, ids that aren't in the database are skipped
+        """
+        with self.lock:
+            ids = [id for id in dict.fromkeys(ids) if id in self.rows]
+            if not ids:
+                return
+
+            self._reserve(self.size) # make sure memory mapped arrays are writable before changing existing rows
+            for id in ids:
+                row = self.rows.pop(id)
+                last = self.size - 1
+                if row != last:
+                    for attr in self.ARRAYS:
+                        getattr(self, attr)[row] = getattr(self, attr)[last]
+                    self.paths[row] = self.paths[last]
+                    self.rows[self.paths[row]] = row
+                self.paths.pop()
+                self.size -= 1
+
+            removed = set(ids)
+            self.unflushed = [id for id in self.unflushed if id not in removed]
+            self.unflushed_removed.extend(ids)
+
+    def _vector(self, row):
+        """
+        Rebuild the RGBF vector stored in a row
+
+        Args:
+            row (int): row of the vector
+
+        Returns:
+            numpy.ndarray
+        """
+        n = self.counts[row]
+        return np.column_stack([self.rgb[row, :n], self.freqs[row, :n]]).reshape(-1)
 
     def get_vector(self, id):
         """
@@ -70,25 +194,24 @@ class VectorDB:
         Returns:
             numpy.ndarray or None if vector not found
         """
-        if np.any(self.vector_data.get(id) != None):
-            return np.asarray(self.vector_data.get(id))
-        else:
+        row = self.rows.get(id)
+        if row is None:
             return None
+        return self._vector(row)
 
-    def update_index(self, id):
-        """
-        Update the index realting a vector to each other vector
+    def __len__(self):
+        return self.size
 
-        Args:
-            id (str or int): unique id for the vector to be indexed
+    def nbytes(self):
         """
-        vec = self.get_vector(id)
-        for id2, vec2 in self.vector_data.items():
-            distance = colors.multidist(vec, vec2)
-            self.vector_index[id2][id] = distance
+        Estimate the memory used by the DB
 
-    def __len__(self):
-        return len(self.vector_data)
+        Returns:
+            int: number of bytes
+        """
+        arrays = sum(getattr(self, attr).nbytes for attr in self.ARRAYS)
+        # rough cost of each path string, list slot and dict entry
+        return arrays + 200 * self.size
 
     def knn(self, query, k = 5):
         """
@@ -104,29 +227,165 @@ class VectorDB:
                 "distance" (float): distance to the query vector
                 "colors" (numpy.ndarray): the vector of the neighbor
         """
+        if self.size == 0:
+            return []
+
+        # score every image in one pass over the feature matrix
+        distances = colors.multidist_many(query, features= self.features[:self.size])
+        order = top_k(distances, k)
+
+        return [{"path": self.paths[i], "distance": distances[i], "colors": self._vector(i)} for i in order]
+
+    def knn_many(self, queries, k = 5):
+        """
+        Get the k nearest neighbors of many query vectors, scoring every query against every vector in one pass
+
+        Args:
+            queries (list[numpy.ndarray]): the query vectors
+            k (int, optional): the number of nearest neighbors to return for each query. default 5
+
+        Returns:
+            list[list[dict]]: the k nearest neighbors of each query, see knn
+        """
+        if self.size == 0 or len(queries) == 0:
+            return [[] for _ in queries]
+
+        distances = colors.multidist_matrix(queries, features= self.features[:self.size])
         results = []
-        for id, vec in tqdm(self.vector_data.items(), desc= "Searching DB..."):
-            distance = colors.multidist(query, vec)
-            results.append({"path": id, "distance": distance, "colors": vec})
-        results.sort(key= lambda x: x["distance"])
-        return results[:k]
+        for row in distances:
+            order = top_k(row, k)
+            results.append([{"path": self.paths[i], "distance": row[i], "colors": self._vector(i)} for i in order])
+        return results
     
+    def _log_path(self):
+        return os.path.join("collections", self.name, f"{self.name}_color_log.jsonl")
+
+    def flush(self):
+        """
+        Append the vectors added or removed since the last flush or save to the log, so they survive a crash without rewriting the whole DB
+        """
+        with self.lock:
+            if not self.unflushed and not self.unflushed_removed:
+                return
+
+            os.makedirs(os.path.join("collections", self.name), exist_ok= True)
+            with open(self._log_path(), "a") as f:
+                # removals first, an id removed and then added again is in unflushed
+                for id in self.unflushed_removed:
+                    f.write(json.dumps({"id": id, "removed": True}) + "\n")
+                for id in self.unflushed:
+                    f.write(json.dumps({"id": id, "vec": self.get_vector(id).tolist()}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.log_size += len(self.unflushed) + len(self.unflushed_removed)
+            self.unflushed = []
+            self.unflushed_removed = []
+            self.disk_stamp = self.file_stamp(self.name)
+
+    def needs_compaction(self):
+        """
+        Check if the log is big enough (compared to the DB) that it should be compacted into the main files
+
+        Returns:
+            bool
+        """
+        return self.log_size + len(self.unflushed) + len(self.unflushed_removed) > self.COMPACT_RATIO * len(self)
+
+    def compact(self, background = False):
+        """
+        Rewrite the main files with everything in the log and clear the log (same as save_DB)
+
+        Args:
+            background (bool, optional): True to save in a new thread and return immediately. default False
+
+        Returns:
+            threading.Thread or None: the thread saving if background is True
+        """
+        if not background:
+            self.save_DB()
+            return None
+
+        thread = threading.Thread(target= self.save_DB, name= f"compact {self.name}")
+        thread.start()
+        return thread
+
     def save_DB(self):
         """
-        Save the Vector_DB object to JSON at the path: ./collections/self.name/self.name.json
+        Save the Vector_DB object to binary files in the folder ./collections/self.name:\n
+        one .npy file per array in VectorDB.ARRAYS (self.name_color_rgb.npy, ...) and the ids in self.name_color_paths.json\n
+        this rewrites every vector so use flush to only save new vectors
+        """
+        with self.lock:
+            folder = os.path.join("collections", self.name)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+            # the files being replaced might be memory mapped by this DB
+            self._reserve(self.size)
+
+            for attr in self.ARRAYS:
+                path = os.path.join(folder, f"{self.name}_color_{attr}.npy")
+                with open(path + ".tmp", "wb") as f:
+                    np.save(f, getattr(self, attr)[:self.size])
+                os.replace(path + ".tmp", path)
+
+            # paths last since get_DB checks for them
+            path = os.path.join(folder, f"{self.name}_color_paths.json")
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.paths, f)
+            os.replace(path + ".tmp", path)
+
+            # if this crashes before the log is removed, loading just replays vectors that are already saved
+            if os.path.exists(self._log_path()):
+                os.remove(self._log_path())
+            self.unflushed = []
+            self.unflushed_removed = []
+            self.log_size = 0
+            self.disk_stamp = self.file_stamp(self.name)
+
+    def _replay_log(self):
+        """
+        Add (or remove) the vectors in the log that aren't in the main files yet
         """
-        if not os.path.exists(os.path.join("collections", self.name)):
-            os.makedirs(os.path.join("collections", self.name))
+        if not os.path.exists(self._log_path()):
+            return
 
-        d = {self.name : {"data" : self.vector_data, "index" : self.vector_index}}
+        ids = []
+        vecs = []
+        count = 0
+        with open(self._log_path(), "r+") as f:
+            end = 0
+            for line in iter(f.readline, ""):
+                try:
+                    entry = json.loads(line) if line.endswith("\n") else None
+                except json.JSONDecodeError:
+                    entry = None
+                if entry is None:
+                    break # last line was cut off by a crash
+                count += 1
+                if entry.get("removed"):
+                    # keep the order of adds and removes
+                    self.add_vectors(ids, vecs)
+                    self.remove_vectors([entry["id"]])
+                    ids, vecs = [], []
+                else:
+                    ids.append(entry["id"])
+                    vecs.append(entry["vec"])
+                end = f.tell()
+            # drop the cut off line so new vectors don't get appended onto it
+            f.truncate(end)
 
-        with open(os.path.join("collections", self.name, f"{self.name}.json"), "w") as f:
-            json.dump(d, f, cls= NumpyEncoder, indent=4)
+        self.add_vectors(ids, vecs)
+        self.unflushed = []
+        self.unflushed_removed = []
+        self.log_size = count
 
     @classmethod
     def get_DB(cls, name):
         """
-        Load a Vector_DB by its name
+        Load a Vector_DB by its name. the arrays are memory mapped so they only get read from disk when used\n
+        DBs saved in the old JSON format are converted on their first load
 
         Args:
             name (str): name of existing Vector_DB to load
@@ -134,14 +393,143 @@ class VectorDB:
         Returns:
             Vector_DB or None if not found
         """
-        if not os.path.exists(os.path.join("collections", name, f"{name}.json")):
+        folder = os.path.join("collections", name)
+        db = cls(name= name)
+
+        if os.path.exists(os.path.join(folder, f"{name}_color_paths.json")):
+            for attr in cls.ARRAYS:
+                setattr(db, attr, np.load(os.path.join(folder, f"{name}_color_{attr}.npy"), mmap_mode= "r"))
+            db.num_colors = db.rgb.shape[1]
+
+            with open(os.path.join(folder, f"{name}_color_paths.json"), "r") as f:
+                db.paths = [sys.intern(id) if isinstance(id, str) else id for id in json.load(f)]
+            db.rows = {id : row for row, id in enumerate(db.paths)}
+            db.size = len(db.paths)
+        elif os.path.exists(os.path.join(folder, f"{name}.json")):
+            return cls._convert_JSON(name)
+        elif not os.path.exists(db._log_path()):
             return None
-        
-        d = {}
-        with open(os.path.join("collections", name, f"{name}.json"), "r") as f:
-            d = json.load(f, cls= NumpyDecoder)
+
+        db._replay_log()
+        db.disk_stamp = cls.file_stamp(name)
+
+        return db
+
+    @staticmethod
+    def file_stamp(name):
+        """
+        Get the modified time and size of the files of a Vector_DB to check if they changed
+
+        Args:
+            name (str): name of the Vector_DB
+
+        Returns:
+            tuple: (modified time, size) or None for the path table, log and old JSON file
+        """
+        folder = os.path.join("collections", name)
+        stamp = []
+        for file in (f"{name}_color_paths.json", f"{name}_color_log.jsonl", f"{name}.json"):
+            try:
+                st = os.stat(os.path.join(folder, file))
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @classmethod
+    def _convert_JSON(cls, name):
+        """
+        Load a Vector_DB saved in the old JSON format (./collections/name/name.json), save it in the binary format and delete the JSON
+
+        Args:
+            name (str): name of existing Vector_DB to convert
+
+        Returns:
+            Vector_DB
+        """
+        json_path = os.path.join("collections", name, f"{name}.json")
+        with open(json_path, "r") as f:
+            d = json.load(f)
 
         vd = d[name]["data"]
-        vi = d[name]["index"]
+        fd = d[name].get("features")
+
+        db = cls(name= name)
+        ids = list(vd.keys())
+        db._reserve(len(ids))
+
+        # DBs saved before features were stored get them all computed at once
+        db.add_vectors(ids, [vd[id] for id in ids], None if fd is None else [fd[id] for id in ids])
+
+        db.save_DB()
+        os.remove(json_path)
+
+        return db
+
+
+class DBRegistry:
+    """
+    Keeps loaded Vector_DBs in memory so every search and window of a collection shares one DB instead of loading it from disk again\n
+    a DB is reloaded if its files were changed by something else, and the least recently used DBs are dropped when they use too much memory
+    """
+    def __init__(self, max_bytes = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.dbs = OrderedDict() # name -> VectorDB, least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, name, create = False):
+        """
+        Get a Vector_DB by its name, loading it if it isn't in memory or its files changed
+
+        Args:
+            name (str): name of the Vector_DB
+            create (bool, optional): True to make (and keep) an empty Vector_DB if it doesn't exist. default False
+
+        Returns:
+            Vector_DB or None if not found and create is False
+        """
+        with self.lock:
+            db = self.dbs.get(name)
+            if db is not None:
+                # waits for a background compaction of the DB to finish
+                with db.lock:
+                    unchanged = db.disk_stamp == VectorDB.file_stamp(name)
+                if unchanged:
+                    self.dbs.move_to_end(name)
+                    return db
+
+            db = VectorDB.get_DB(name)
+            if db is None:
+                if not create:
+                    self.dbs.pop(name, None)
+                    return None
+                db = VectorDB(name= name)
+                db.disk_stamp = VectorDB.file_stamp(name)
+
+            self.dbs[name] = db
+            self.dbs.move_to_end(name)
+            self._evict()
+            return db
+
+    def close(self, name):
+        """
+        Drop a Vector_DB from memory (e.g. before deleting its files)
+
+        Args:
+            name (str): name of the Vector_DB
+        """
+        with self.lock:
+            self.dbs.pop(name, None)
+
+    def _evict(self):
+        """
+        Drop the least recently used DBs until they fit in self.max_bytes, always keeping the most recent one
+        """
+        total = sum(db.nbytes() for db in self.dbs.values())
+        while total > self.max_bytes and len(self.dbs) > 1:
+            _, db = self.dbs.popitem(last= False)
+            total -= db.nbytes()
+
 
-        return cls(name= name, vector_data= vd, vector_index= vi)
\ No newline at end of file
+# shared by everything in the process
+color_dbs = DBRegistry()
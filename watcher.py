@@ -0,0 +1,241 @@
+"""watches the folders of collections and keeps their color, DINO and CLIP indexes up to date as images are added, edited or removed\n
+native file system events are used if watchdog is installed (inotify on Linux, ReadDirectoryChangesW on Windows),
+otherwise the folders are scanned every few seconds. bursts of events are debounced into one update"""
+
+import os
+import json
+import threading
+import discovery
+
+
+class FolderWatcher:
+    """
+    Calls on_change with the images that were added, removed or edited in a folder once it has been quiet for debounce seconds
+    """
+    def __init__(self, folder_path, explore, on_change, debounce = 2.0, poll_interval = 10.0, native = True):
+        self.folder_path = folder_path
+        self.explore = explore
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.native = native
+
+        self.snapshot = {} # path -> (size, mtime_ns) of the last scan
+        self.event = threading.Event() # set when the folder might have changed
+        self.stopped = threading.Event()
+        self.observer = None
+        self.thread = None
+
+    def _scan(self):
+        discovery.invalidate(self.folder_path)
+        return {path : (size, mtime_ns) for path, size, mtime_ns in discovery.scan(self.folder_path, self.explore, refresh= True)}
+
+    def _start_observer(self):
+        """
+        Start watching for native file system events
+
+        Returns:
+            bool: False if watchdog isn't installed or the folder can't be watched (e.g. out of inotify watches)
+        """
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return False
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                # opening or reading a file doesn't change it
+                if event.event_type not in ("opened", "closed_no_write"):
+                    watcher.event.set()
+
+        try:
+            self.observer = Observer()
+            self.observer.schedule(Handler(), self.folder_path, recursive= self.explore)
+            self.observer.start()
+        except Exception as e:
+            print(f"Can't watch {self.folder_path}, checking it every {self.poll_interval} seconds instead : {e}")
+            self.observer = None
+            return False
+        return True
+
+    def start(self, catch_up = False):
+        """
+        Start watching the folder
+
+        Args:
+            catch_up (bool, optional): True to call on_change once right away with nothing changed,
+                so changes made while nothing was watching get picked up. default False
+        """
+        self.thread = threading.Thread(target= self._run, args= (catch_up,), name= f"watch {self.folder_path}", daemon= True)
+        self.thread.start()
+
+    def stop(self, wait = True):
+        """
+        Stop watching the folder, an update that's running finishes first
+
+        Args:
+            wait (bool, optional): True to wait for a running update to finish. default True
+        """
+        self.stopped.set()
+        self.event.set()
+        if self.observer is not None:
+            self.observer.stop()
+        if wait and self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _run(self, catch_up):
+        # listing a big folder (and adding a watch to each subfolder) can take a while, so it's done here instead of in start
+        try:
+            self.snapshot = self._scan()
+        except OSError as e:
+            print(f"Error scanning {self.folder_path} : {e}")
+            self.snapshot = {}
+        if not (self.native and self._start_observer()):
+            self.observer = None
+        if self.stopped.is_set():
+            self.stop(wait= False)
+            return
+
+        if catch_up:
+            self._call([], [], [])
+
+        while not self.stopped.is_set():
+            if self.observer is not None:
+                self.event.wait()
+            else:
+                self.event.wait(self.poll_interval)
+            if self.stopped.is_set():
+                return
+
+            # wait for the events to stop so copying a folder of images is one update
+            while True:
+                self.event.clear()
+                if not self.event.wait(self.debounce):
+                    break
+                if self.stopped.is_set():
+                    return
+            self.check()
+
+    def check(self):
+        """
+        Scan the folder and call on_change if any image was added, removed or edited since the last scan
+        """
+        try:
+            snapshot = self._scan()
+        except OSError as e:
+            # e.g. a network share that's disconnected, keep the old snapshot so nothing looks removed
+            print(f"Error scanning {self.folder_path} : {e}")
+            return
+
+        added = [path for path in snapshot if path not in self.snapshot]
+        removed = [path for path in self.snapshot if path not in snapshot]
+        modified = [path for path, stat in snapshot.items() if path in self.snapshot and self.snapshot[path] != stat]
+        self.snapshot = snapshot
+        if added or removed or modified:
+            self._call(added, removed, modified)
+
+    def _call(self, added, removed, modified):
+        try:
+            self.on_change(added, removed, modified)
+        except Exception as e:
+            print(f"Error updating {self.folder_path} : {e}")
+
+
+class CollectionWatchers:
+    """
+    Keeps a FolderWatcher on the folder of each collection, updating its indexes and its image_count in the collections file on changes
+    """
+    def __init__(self, collections_file = "collections.json", on_updated = None, **watcher_args):
+        self.collections_file = collections_file
+        self.on_updated = on_updated # called with the uuid of a collection after it's updated, from a watcher's thread
+        self.watcher_args = watcher_args # passed to each FolderWatcher
+        self.watchers = {} # uuid -> FolderWatcher
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+
+    def sync(self, collections):
+        """
+        Watch the folders of the given collections, stop watching removed collections and restart watchers whose folder changed
+
+        Args:
+            collections (dict): uuid -> collection data (with "folder" and "subfolders")
+        """
+        with self.lock:
+            for uuid in list(self.watchers):
+                watcher = self.watchers[uuid]
+                data = collections.get(uuid)
+                if data is None or (data.get("folder"), data.get("subfolders", False)) != (watcher.folder_path, watcher.explore):
+                    self.watchers.pop(uuid).stop(wait= False)
+
+            for uuid, data in collections.items():
+                if uuid in self.watchers or not data.get("folder") or not os.path.isdir(data["folder"]):
+                    continue
+                watcher = FolderWatcher(data["folder"], data.get("subfolders", False),
+                                        lambda added, removed, modified, uuid= uuid: self.update(uuid, added, removed, modified),
+                                        **self.watcher_args)
+                watcher.start()
+                self.watchers[uuid] = watcher
+
+    def stop(self, wait = True):
+        """
+        Stop every watcher
+
+        Args:
+            wait (bool, optional): True to wait for running updates to finish. default True
+        """
+        with self.lock:
+            for watcher in self.watchers.values():
+                watcher.stop(wait)
+            self.watchers.clear()
+
+    def _load(self):
+        if not os.path.exists(self.collections_file):
+            return {}
+        with open(self.collections_file, "r") as f:
+            return json.load(f)
+
+    def update(self, uuid, added, removed, modified):
+        """
+        Bring a collection's indexes up to date with its folder and refresh its image_count\n
+        the indexes only embed new or edited images and drop removed ones (see accessDBs.add_color and accessDBs.add_visual)
+
+        Args:
+            uuid (str): the collection's uuid
+            added (list[str]): paths of new images
+            removed (list[str]): paths of removed images
+            modified (list[str]): paths of edited images
+        """
+        from accessDBs import add_color, add_visual
+
+        # read again since indexes might have been made since the watcher started
+        data = self._load().get(uuid)
+        if data is None:
+            return
+        folder, explore = data["folder"], data.get("subfolders", False)
+
+        # each index is updated on its own so one failing doesn't leave the others (or the count) behind
+        # (the update locks in accessDBs make these wait for an index the app is making or updating)
+        updates = [("colors", lambda: add_color(uuid, folder, explore, changed= modified))] if data.get("color") else []
+        updates += [(model, lambda model= model: add_visual(uuid, folder, explore, model= model))
+                    for model in ("dino", "clip") if data.get(model)]
+        for model, update in updates:
+            try:
+                update()
+            except Exception as e:
+                print(f"Error updating the {model} index of {data.get('name', uuid)} : {e}")
+
+        try:
+            count = discovery.count_images(folder, explore)
+            with self.file_lock:
+                collections = self._load()
+                if uuid in collections and collections[uuid].get("image_count") != count:
+                    collections[uuid]["image_count"] = count
+                    with open(self.collections_file + ".tmp", "w") as f:
+                        json.dump(collections, f, indent= 4)
+                    os.replace(self.collections_file + ".tmp", self.collections_file)
+        finally:
+            if self.on_updated is not None:
+                self.on_updated(uuid)